@@ -1,10 +1,14 @@
 import os
+import re
 import json
+import time
+import atexit
+import random
+import hashlib
+import asyncio
 from pathlib import Path
-#import openai
-from anthropic import Anthropic, AsyncAnthropic
-#from openrouter import OpenRouter 
-#import google.generativeai as genai
+import importlib
+from collections import OrderedDict
 
 # Map of model shortcodes to full model names
 MODELS = {
@@ -34,204 +38,956 @@ MODELS = {
     'I': 'gemini-exp-1206'
 }
 
-# def openai_chat(client_class, use_model):
-    # messages = []
-    # extend_function = None
-    
-    # async def ask(user_message, system=None, model=None, temperature=0.0, 
-                 # max_tokens=8192, stream=True, shorten=lambda x: x, 
-                 # extend=None, predict=None):
-        # if user_message is None:
-            # return {'messages': messages}
-            
-        # reasoning_effort = None
-        # model = MODELS.get(model, model or use_model)
-        # client = client_class(api_key=get_token(client_class.__name__.lower()))
-        
-        # is_o1 = model.startswith("o1")
-        
-        # max_completion_tokens = None
-        # if is_o1:
-            # stream = False
-            # temperature = 1
-            # max_completion_tokens = max_tokens
-            # max_tokens = None
-            # reasoning_effort = "high"
-            
-        # if len(messages) == 0 and system:
-            # if is_o1:
-                # messages.append({"role": "user", "content": system})
-            # else:
-                # messages.append({"role": "system", "content": system})
-                
-        # extended_message = extend_function(user_message) if extend_function else user_message
-        # nonlocal extend_function
-        # extend_function = extend
-        
-        # messages_copy = messages + [{"role": "user", "content": extended_message}]
-        # messages.append({"role": "user", "content": user_message})
-        
-        # prediction = {"type": "content", "content": predict} if predict and "o1" not in model else None
-        
-        # params = {
-            # "messages": messages_copy,
-            # "model": model,
-            # "temperature": temperature,
-            # "max_tokens": max_tokens,
-            # "max_completion_tokens": max_completion_tokens,
-            # "reasoning_effort": reasoning_effort,
-            # "stream": stream,
-            # "prediction": prediction
-        # }
-        
-        # result = ""
-        # response = await client.chat.completions.create(**params)
-        
-        # if stream:
-            # async for chunk in response:
-                # text = chunk.choices[0].delta.content or ""
-                # print(text, end="", flush=True)
-                # result += text
-        # else:
-            # text = response.choices[0].message.content or ""
-            # print(text, end="", flush=True)
-            # result = text
-            
-        # messages.append({"role": "assistant", "content": await shorten(result)})
-        # return result
-        
-    # return ask
+# Context window (in tokens) of each full model name
+CONTEXT_WINDOWS = {
+    'gpt-4o-mini': 128000,
+    'gpt-4o-2024-11-20': 128000,
+    'o1-mini': 128000,
+    'o1': 200000,
+    'claude-3-5-haiku-20241022': 200000,
+    'claude-3-5-sonnet-latest': 200000,
+    'claude-3-5-sonnet-20241022': 200000,
+    'claude-3-5-sonnet-20240620': 200000,
+    'deepseek-chat': 64000,
+    'meta-llama/llama-3.2-8b-instruct': 128000,
+    'meta-llama/llama-3.3-70b-instruct': 128000,
+    'meta-llama/llama-3.2-405b-instruct': 128000,
+    'gemini-2.0-flash-exp': 1048576,
+    'gemini-exp-1206': 2097152,
+}
+DEFAULT_CONTEXT_WINDOW = 128000
 
+# History is compacted once it passes COMPACT_AT of the budget left after
+# reserving max_tokens for the reply, down to COMPACT_TO of it. Compacting in
+# large steps keeps the conversation prefix (and its prompt cache) stable
+# between compactions.
+COMPACT_AT = 0.8
+COMPACT_TO = 0.5
+TOOL_OUTPUT_MAX = 8000
+TOOL_OUTPUT = re.compile(r"<SYSTEM>\n([\s\S]*?)\n</SYSTEM>")
 
-def anthropic_chat(client_class, MODEL):
+def echo(text):
+    print(text, end="", flush=True)
+
+# Keeps the beginning and the end of a long text, where command output
+# usually carries its information.
+def head_tail(text, max_chars=TOOL_OUTPUT_MAX):
+    if len(text) <= max_chars:
+        return text
+    # The marker counts towards max_chars (its count is at most len(text))
+    half = max(max_chars - len(f"\n[... {len(text)} chars omitted ...]\n"), 0) // 2
+    omitted = len(text) - 2 * half
+    return f"{text[:half]}\n[... {omitted} chars omitted ...]\n{text[len(text) - half:]}"
+
+def trim_tool_outputs(text):
+    return TOOL_OUTPUT.sub(lambda m: f"<SYSTEM>\n{head_tail(m.group(1))}\n</SYSTEM>", text)
+
+# Shrinks `messages` in place so that, with the system prompt and the next
+# message, it fits the model's budget: first old tool outputs are trimmed to
+# head/tail, then the oldest turns are dropped (or replaced by a summary, if
+# `summarize` is given). Returns the number of tokens saved.
+async def compact(messages, system, next_message, model, max_tokens, summarize=None):
+    budget = CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW) - max_tokens
+    fixed = token_count(system or "", model) + token_count(next_message, model)
+    sizes = [token_count(m["content"], model) for m in messages]
+    before = fixed + sum(sizes)
+    if before <= budget * COMPACT_AT:
+        return 0
+    target = budget * COMPACT_TO
+
+    # The newest exchange is left intact, the model may still be working on it
+    for i in range(len(messages) - 2):
+        if fixed + sum(sizes) <= target:
+            break
+        trimmed = trim_tool_outputs(messages[i]["content"])
+        if trimmed != messages[i]["content"]:
+            messages[i] = {**messages[i], "content": trimmed}
+            sizes[i] = token_count(trimmed, model)
+
+    evicted = []
+    while len(messages) > 2 and fixed + sum(sizes) > target:
+        evicted += messages[:2]
+        del messages[:2], sizes[:2]
+    if evicted:
+        if summarize:
+            note = f"[Summary of {len(evicted)} earlier messages]\n{await summarize(evicted)}"
+        else:
+            note = f"[{len(evicted)} earlier messages omitted]"
+        messages[0] = {**messages[0], "content": note + "\n\n" + messages[0]["content"]}
+        sizes[0] = token_count(messages[0]["content"], model)
+
+    return before - (fixed + sum(sizes))
+
+# Marks the newest user turn as a cache breakpoint, so the next request can
+# read the whole conversation prefix from cache. The previous user turn keeps
+# its breakpoint too: it is what was written last time, and the cache lookback
+# would not reach it once turns carry many blocks.
+def cache_breakpoints(messages):
+    marked = list(messages)
+    user_turns = [i for i, m in enumerate(marked) if m["role"] == "user"]
+    for i in user_turns[-2:]:
+        content = marked[i]["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        content = content[:-1] + [{**content[-1], "cache_control": {"type": "ephemeral"}}]
+        marked[i] = {**marked[i], "content": content}
+    return marked
+
+# Every provider is a `send(request, emit)` coroutine: it streams the reply
+# for `request` (model, system, messages, temperature, max_tokens, stream,
+# system_cacheable, history_cacheable, predict) through `emit`, and returns
+# the usage in Anthropic's terms (input_tokens, output_tokens,
+# cache_read_input_tokens, cache_creation_input_tokens). make_chat() turns
+# a provider into an `ask` that keeps the conversation, compacts it, queues
+# it behind the model's Limiter, retries transient failures and measures
+# each call.
+#
+# `ask.on(event, handler)` subscribes to a call's events. Each handler gets a
+# dict with "event", the call "id", "model" and "time" (perf_counter), plus:
+#   start        messages, ts (wall clock)
+#   first_token  ttft
+#   chunk        text
+#   retry        error, attempt, delay
+#   skipped      block (a reply part that is not text)
+#   end          last (a copy of the call's ttft, latency, usage, retries, ...)
+#   error        error, latency
+EVENTS = ("start", "first_token", "chunk", "retry", "skipped", "end", "error")
+RETRIES = 5
+RETRY_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+
+def is_transient(error):
+    status = getattr(error, 'status_code', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+    if status:
+        return status in (408, 409, 429) or status >= 500
+    return isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError)) or type(error).__name__ in (
+        'APIConnectionError', 'APITimeoutError', 'ServiceUnavailable', 'ResourceExhausted', 'InternalServerError')
+
+def is_rate_limit(error):
+    status = getattr(error, 'status_code', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+    return status in (429, 529) or type(error).__name__ == 'ResourceExhausted'
+
+# The server's retry-after if it sent one, else exponential backoff with
+# jitter, so that requests that failed together do not retry together.
+def retry_delay(error, attempt):
+    headers = getattr(error, 'headers', None) or getattr(getattr(error, 'response', None), 'headers', None) or {}
+    for name, scale in (('retry-after-ms', 0.001), ('retry-after', 1.0)):
+        try:
+            return min(float(headers.get(name)) * scale, RETRY_MAX_DELAY)
+        except (TypeError, ValueError):
+            pass
+    delay = min(RETRY_DELAY * 2 ** attempt, RETRY_MAX_DELAY)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+# Requests in flight and tokens per minute allowed per model, matched by
+# prefix (None: unlimited). Tokens are input tokens, reserved up front, plus
+# output tokens, charged when the reply is done. Set these to the account's
+# tier; $AI_CONCURRENCY and $AI_TPM override them for every model.
+RATE_LIMITS = {
+    'claude': (8, None),
+    'gpt': (8, None),
+    'o1': (4, None),
+    'chatgpt': (8, None),
+    'deepseek': (8, None),
+    'meta': (8, None),
+    'gemini': (8, None),
+    'local': (32, None),
+    'mock': (64, None),
+}
+DEFAULT_RATE_LIMIT = (8, None)
+
+# Admission control for one model, shared by every ask in the process.
+# Waiting requests are admitted in arrival order. A rate-limit error pauses
+# admission for everyone until the server's retry-after has passed.
+class Limiter:
+    def __init__(self, concurrency, tpm):
+        self.slots = asyncio.Semaphore(concurrency)
+        self.turn = asyncio.Lock()
+        self.tpm = tpm
+        self.tokens = tpm or 0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.tpm, self.tokens + (now - self.updated) * self.tpm / 60)
+        self.updated = now
+
+    async def acquire(self, tokens):
+        async with self.turn:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if self.tpm:
+                    self.refill()
+                    # A request larger than the whole quota waits for a full bucket
+                    wait = max(wait, (min(tokens, self.tpm) - self.tokens) * 60 / self.tpm)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if self.tpm:
+                self.tokens -= tokens
+        await self.slots.acquire()
+
+    def release(self, reserved, usage=None):
+        self.slots.release()
+        if self.tpm and usage:
+            used = (usage.get("input_tokens") or reserved) + (usage.get("output_tokens") or 0)
+            self.tokens -= used - reserved
+
+    def pause(self, delay):
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+limiters = {}
+
+def get_limiter(model):
+    # asyncio primitives belong to one event loop
+    key = (id(asyncio.get_running_loop()), model)
+    if key not in limiters:
+        concurrency, tpm = next((limit for prefix, limit in RATE_LIMITS.items() if model.startswith(prefix)),
+                                DEFAULT_RATE_LIMIT)
+        concurrency = int(os.environ.get('AI_CONCURRENCY') or concurrency)
+        tpm = int(os.environ.get('AI_TPM') or 0) or tpm
+        limiters[key] = Limiter(concurrency, tpm)
+    return limiters[key]
+
+call_ids = iter(range(1, 1 << 62))
+
+def make_chat(send, MODEL):
     messages = []
-    
+    last = {}
+    hooks = {event: [] for event in EVENTS}
+
+    def on(event, handler):
+        if event not in hooks:
+            raise ValueError(f"Unknown event: {event}")
+        hooks[event].append(handler)
+
     async def ask(user_message, system=None, model=None, temperature=0.0,
                  max_tokens=8192, stream=True, system_cacheable=False,
-                 shorten=lambda x: x, extend=None):
+                 history_cacheable=False, shorten=lambda x: x, extend=None,
+                 on_text=echo, summarize=None, predict=None):
         if user_message is None:
-            return {'messages': messages}
-            
+            return {'messages': messages, 'last': last}
+
         model = model or MODEL
         model = MODELS.get(model, model)
-        client = client_class(
-            api_key=get_token(client_class.__name__.lower()),
-            default_headers={
-                "anthropic-beta": "prompt-caching-2024-07-31"
-            }
-        )
-        
+
         extended_message = extend(user_message) if extend else user_message
+        saved_tokens = await compact(messages, system, extended_message, model, max_tokens, summarize)
         messages_copy = messages + [{"role": "user", "content": extended_message}]
         messages.append({"role": "user", "content": user_message})
-        
-        cached_system = [{"type": "text", "text": system}] #, "cache_control": {"type": "ephemeral"}}]
-        prompt_system = cached_system if system_cacheable else system
-        
-        params = {
-            "system": prompt_system,
+
+        request = {
             "model": model,
+            "system": system,
+            "messages": messages_copy,
             "temperature": temperature,
             "max_tokens": max_tokens,
-            #"stream": stream
+            "stream": stream,
+            "system_cacheable": system_cacheable,
+            "history_cacheable": history_cacheable,
+            "predict": predict,
         }
-        
-        result = ""
-        response = client.messages.create(**params, messages=messages_copy)
-        for message in response.content:
-            if stream and hasattr(message, 'text'):
-                print(message.text, end="", flush=True)
-                result += message.text
-            else:
-                print("Skipped2 ", repr(message))
-            
+
+        call_id = next(call_ids)
+        chunks = []
+        first_token = None
+
+        def notify(event, **data):
+            for handler in hooks[event]:
+                handler({"event": event, "id": call_id, "model": model, "time": time.perf_counter(), **data})
+
+        def emit(text):
+            nonlocal first_token
+            if first_token is None:
+                first_token = time.perf_counter()
+                notify("first_token", ttft=first_token - start)
+            chunks.append(text)
+            notify("chunk", text=text)
+            on_text(text)
+
+        emit.notify = notify
+        start = time.perf_counter()
+        notify("start", messages=len(messages_copy), ts=time.time())
+        limiter = get_limiter(model)
+        reserved = token_count(system or "", model) + sum(token_count(m["content"], model) for m in messages_copy)
+        retries = 0
+        queued = 0.0
+        try:
+            while True:
+                admitted = time.perf_counter()
+                await limiter.acquire(reserved)
+                queued += time.perf_counter() - admitted
+                usage = None
+                try:
+                    usage = await send(request, emit)
+                    break
+                except Exception as e:
+                    # Once text was shown, a retry would repeat it
+                    if chunks or retries >= RETRIES or not is_transient(e):
+                        raise
+                    delay = retry_delay(e, retries)
+                    if is_rate_limit(e):
+                        limiter.pause(delay)
+                    retries += 1
+                    notify("retry", error=e, attempt=retries, delay=delay)
+                finally:
+                    limiter.release(reserved, usage)
+                await asyncio.sleep(delay)
+        except BaseException as e:
+            # A failed or cancelled turn leaves no trace in the history
+            messages.pop()
+            notify("error", error=e, latency=time.perf_counter() - start)
+            raise
+        end = time.perf_counter()
+        result = ''.join(chunks)
+
+        last.clear()
+        last.update({
+            "model": model,
+            "ttft": (first_token or end) - start,
+            "latency": end - start,
+            "usage": usage or {},
+            "retries": retries,
+            "queued": queued,
+            "saved_tokens": saved_tokens,
+        })
+        last["cache_read"] = last["usage"].get("cache_read_input_tokens") or 0
+        last["cache_write"] = last["usage"].get("cache_creation_input_tokens") or 0
         messages.append({"role": "assistant", "content": shorten(result)})
+        notify("end", last=dict(last))
         return result
-        
+
+    ask.on = on
     return ask
 
-# def gemini_chat(client_class):
-    # messages = []
-    # extend_function = None
-    
-    # async def ask(user_message, system=None, model=None, temperature=0.0,
-                 # max_tokens=8192, stream=True, shorten=lambda x: x, extend=None):
-        # if user_message is None:
-            # return {'messages': messages}
-            
-        # model = MODELS.get(model, model)
-        # client = client_class(get_token(client_class.__name__.lower()))
-        
-        # generation_config = {
-            # "maxOutputTokens": max_tokens,
-            # "temperature": temperature
-        # }
-        
-        # safety_settings = [
-            # {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-            # {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-            # {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-            # {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"}
-        # ]
-        
-        # extended_message = extend_function(user_message) if extend_function else user_message
-        # nonlocal extend_function
-        # extend_function = extend
-        
-        # messages_copy = messages + [{"role": "user", "parts": [{"text": extended_message}]}]
-        # messages.append({"role": "user", "parts": [{"text": user_message}]})
-        
-        # chat = client.get_generative_model(
-            # model=model,
-            # generation_config=generation_config
-        # ).start_chat(
-            # history=messages_copy,
-            # safety_settings=safety_settings
-        # )
-        
-        # result = ""
-        # if stream:
-            # response = await chat.send_message_stream(extended_message)
-            # async for chunk in response.stream:
-                # text = chunk.text()
-                # print(text, end="", flush=True)
-                # result += text
-        # else:
-            # response = await chat.send_message(extended_message)
-            # result = (await response.response).text()
-            
-        # messages.append({"role": "model", "parts": [{"text": await shorten(result)}]})
-        # return result
-        
-    # return ask
+def anthropic_chat(client_class, MODEL):
+    async def send(request, emit):
+        client = get_client(client_class, "anthropic", {
+            "anthropic-beta": "prompt-caching-2024-07-31"
+        })
+
+        messages = request["messages"]
+        if request["history_cacheable"]:
+            messages = cache_breakpoints(messages)
+
+        system = request["system"]
+        cached_system = [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}]
+
+        params = {
+            "model": request["model"],
+            "temperature": request["temperature"],
+            "max_tokens": request["max_tokens"],
+            "messages": messages,
+        }
+        if system:
+            params["system"] = cached_system if request["system_cacheable"] else system
+
+        if request["stream"]:
+            async with client.messages.stream(**params) as response:
+                async for text in response.text_stream:
+                    emit(text)
+                final = await response.get_final_message()
+        else:
+            final = await client.messages.create(**params)
+            for message in final.content:
+                if hasattr(message, 'text'):
+                    emit(message.text)
+                else:
+                    emit.notify("skipped", block=repr(message))
+        return final.usage.model_dump() if final.usage else {}
+
+    return make_chat(send, MODEL)
+
+# Models that take a predicted output (`predict`): the parts of the reply
+# that match it are not generated token by token.
+PREDICTION_MODELS = ('gpt-4o',)
+
+def supports_prediction(model):
+    return MODELS.get(model, model).startswith(PREDICTION_MODELS)
+
+# OpenAI's API, and the OpenAI-compatible ones (DeepSeek, OpenRouter)
+def openai_chat(client_class, MODEL, vendor="openai", base_url=None):
+    async def send(request, emit):
+        client = get_client(client_class, vendor, base_url=base_url)
+        model = request["model"]
+        is_o1 = model.startswith("o1")
+
+        messages = list(request["messages"])
+        if request["system"]:
+            messages.insert(0, {"role": "user" if is_o1 else "system", "content": request["system"]})
+
+        params = {"model": model, "messages": messages}
+        stream = request["stream"]
+        if is_o1:
+            stream = False
+            params["max_completion_tokens"] = request["max_tokens"]
+            if not model.startswith("o1-mini"):
+                params["reasoning_effort"] = "high"
+        else:
+            params["max_tokens"] = request["max_tokens"]
+            params["temperature"] = request["temperature"]
+            if request["predict"]:
+                params["prediction"] = {"type": "content", "content": request["predict"]}
+
+        usage = None
+        if stream:
+            response = await client.chat.completions.create(**params, stream=True, stream_options={"include_usage": True})
+            async for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    emit(chunk.choices[0].delta.content)
+                usage = chunk.usage or usage
+        else:
+            response = await client.chat.completions.create(**params)
+            emit(response.choices[0].message.content or "")
+            usage = response.usage
+        return openai_usage(usage.model_dump() if usage else {})
+
+    return make_chat(send, MODEL)
+
+def openai_usage(usage):
+    return {
+        "input_tokens": usage.get("prompt_tokens"),
+        "output_tokens": usage.get("completion_tokens"),
+        "cache_read_input_tokens": (usage.get("prompt_tokens_details") or {}).get("cached_tokens"),
+    }
+
+GEMINI_SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"}
+]
+
+def gemini_chat(genai, MODEL):
+    async def send(request, emit):
+        if "gemini" not in tokens:
+            genai.configure(api_key=get_token("gemini"))
+        contents = [{"role": "model" if m["role"] == "assistant" else "user", "parts": [m["content"]]}
+                    for m in request["messages"]]
+        generative_model = genai.GenerativeModel(request["model"], system_instruction=request["system"] or None)
+        response = await generative_model.generate_content_async(
+            contents,
+            stream=request["stream"],
+            generation_config={"max_output_tokens": request["max_tokens"], "temperature": request["temperature"]},
+            safety_settings=GEMINI_SAFETY_SETTINGS
+        )
+        if request["stream"]:
+            async for chunk in response:
+                emit(chunk.text)
+        else:
+            emit(response.text)
+        meta = response.usage_metadata
+        return {
+            "input_tokens": getattr(meta, "prompt_token_count", None),
+            "output_tokens": getattr(meta, "candidates_token_count", None),
+            "cache_read_input_tokens": getattr(meta, "cached_content_token_count", None),
+        }
+
+    return make_chat(send, MODEL)
+
+# Any OpenAI-compatible server at $AI_LOCAL_URL ("local:<model>"), such as
+# MockServer.py, spoken to with the standard library only.
+LOCAL_URL = os.environ.get('AI_LOCAL_URL', 'http://127.0.0.1:8765')
+
+class HTTPStatusError(Exception):
+    def __init__(self, status_code, headers, body):
+        super().__init__(f"HTTP {status_code}: {body[:200]}")
+        self.status_code = status_code
+        self.headers = headers
+
+async def http_lines(url, payload, headers=None):
+    import urllib.parse
+    parts = urllib.parse.urlsplit(url)
+    reader, writer = await asyncio.open_connection(
+        parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80),
+        ssl=True if parts.scheme == 'https' else None)
+    try:
+        body = json.dumps(payload).encode('utf-8')
+        head = [f"POST {parts.path or '/'} HTTP/1.1", f"Host: {parts.netloc}",
+                "Content-Type: application/json", f"Content-Length: {len(body)}", "Connection: close"]
+        head += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode('utf-8') + body)
+        await writer.drain()
+
+        status = int((await reader.readline()).split()[1])
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        async def body_parts():
+            if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+                while True:
+                    size = int((await reader.readline()).split(b';')[0], 16)
+                    if size == 0:
+                        return
+                    yield await reader.readexactly(size)
+                    await reader.readline()
+            else:
+                while True:
+                    data = await reader.read(65536)
+                    if not data:
+                        return
+                    yield data
+
+        if status >= 400:
+            error = b"".join([data async for data in body_parts()])
+            raise HTTPStatusError(status, response_headers, error.decode('utf-8', errors='replace'))
+
+        buffer = b""
+        async for data in body_parts():
+            buffer += data
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                yield line.decode('utf-8').rstrip('\r')
+        if buffer:
+            yield buffer.decode('utf-8').rstrip('\r')
+    finally:
+        writer.close()
+
+def local_chat(MODEL):
+    async def send(request, emit):
+        messages = list(request["messages"])
+        if request["system"]:
+            messages.insert(0, {"role": "system", "content": request["system"]})
+        payload = {
+            "model": request["model"].partition(':')[2] or request["model"],
+            "messages": messages,
+            "max_tokens": request["max_tokens"],
+            "temperature": request["temperature"],
+            "stream": True,
+            "stream_options": {"include_usage": True},
+        }
+        usage = {}
+        async for line in http_lines(LOCAL_URL + '/v1/chat/completions', payload):
+            if not line.startswith('data: ') or line == 'data: [DONE]':
+                continue
+            chunk = json.loads(line[len('data: '):])
+            for choice in chunk.get("choices") or []:
+                if (choice.get("delta") or {}).get("content"):
+                    emit(choice["delta"]["content"])
+            usage = chunk.get("usage") or usage
+        return openai_usage(usage)
+
+    return make_chat(send, MODEL)
+
+# Offline stand-in for a model, for tests and benchmarks. "mock:0.5" answers
+# after 0.5s, streaming MOCK_REPLY (or $AI_MOCK_REPLY) word by word.
+MOCK_REPLY = os.environ.get('AI_MOCK_REPLY', "<COMPLETION>mock</COMPLETION>")
+
+def mock_chat(MODEL):
+    async def send(request, emit):
+        latency = float(request["model"].partition(':')[2] or 0)
+        words = re.findall(r"\S*\s*", MOCK_REPLY)[:-1] or [""]
+        for word in words:
+            await asyncio.sleep(latency / len(words))
+            emit(word)
+        model = request["model"]
+        input_tokens = token_count(request["system"] or "", model)
+        input_tokens += sum(token_count(m["content"], model) for m in request["messages"])
+        return {"input_tokens": input_tokens, "output_tokens": token_count(MOCK_REPLY, model)}
+
+    return make_chat(send, MODEL)
+
+# Clients are shared across asks and chat() instances, so that connection
+# pools (and their keep-alive TLS sessions) survive between turns.
+clients = {}
+tokens = {}
+client_stats = {"hits": 0, "misses": 0}
+
+def get_client(client_class, vendor, headers=None, **options):
+    headers = headers or {}
+    key = (vendor, client_class.__name__, tuple(sorted(headers.items())), tuple(sorted(options.items())))
+    client = clients.get(key)
+    if client is None:
+        client_stats["misses"] += 1
+        # Retries are done by make_chat, across providers
+        client = client_class(api_key=get_token(vendor), default_headers=headers, max_retries=0,
+                              **{name: value for name, value in options.items() if value is not None})
+        clients[key] = client
+    else:
+        client_stats["hits"] += 1
+    return client
+
+# Async clients must be closed from inside the event loop that used them;
+# call aclose_clients() before leaving asyncio.run(). close_clients() is the
+# atexit fallback and only releases what it can without a loop.
+async def aclose_clients():
+    while clients:
+        _, client = clients.popitem()
+        result = client.close()
+        if asyncio.iscoroutine(result):
+            await result
+
+def close_clients():
+    while clients:
+        _, client = clients.popitem()
+        result = client.close()
+        if asyncio.iscoroutine(result):
+            result.close()
+
+atexit.register(close_clients)
 
 def get_token(vendor):
+    if vendor in tokens:
+        return tokens[vendor]
+    if os.environ.get(f'{vendor.upper()}_API_KEY'):
+        tokens[vendor] = os.environ[f'{vendor.upper()}_API_KEY']
+        return tokens[vendor]
     token_path = Path.home() / '.config' / f'{vendor}.token'
     try:
-        return token_path.read_text().strip()
-    except Exception as e:
-        print(f"Error reading {vendor}.token file:", str(e))
-        exit(1)
+        tokens[vendor] = token_path.read_text().strip()
+        return tokens[vendor]
+    except OSError as e:
+        # Raised, not exited: this runs inside the daemon's request tasks
+        raise RuntimeError(f"no {vendor.upper()}_API_KEY and cannot read {token_path}: {e.strerror}") from e
+
+# Splits "--name=value" / "--name" options out of a script's arguments.
+def split_flags(argv):
+    args, flags = [], {}
+    for arg in argv:
+        if arg.startswith('--') and len(arg) > 2:
+            name, _, value = arg[2:].partition('=')
+            flags[name] = value if value else True
+        else:
+            args.append(arg)
+    return args, flags
+
+# A numeric option: `default` when absent, and an error (rather than 1) for
+# a bare "--name" or a value that is not a number
+def number_flag(flags, name, default=None, kind=int):
+    if name not in flags:
+        return default
+    try:
+        if flags[name] is True:
+            raise ValueError
+        return kind(flags[name])
+    except ValueError:
+        raise ValueError(f"--{name} takes a number, as in --{name}=N") from None
+
+# --profile-startup: the time `import <script>` takes in a fresh interpreter,
+# the imports it goes to, and what each provider SDK adds on first use.
+STARTUP_TARGET = 0.1
+IMPORT_TIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+def profile_startup(script, runs=5):
+    import sys
+    import subprocess
+
+    def wall(code, *options):
+        best = None
+        for _ in range(runs):
+            start = time.perf_counter()
+            result = subprocess.run([sys.executable, *options, '-c', code], capture_output=True, text=True,
+                                    cwd=Path(__file__).parent)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, result
+
+    interpreter, _ = wall('pass')
+    total, _ = wall(f'import {script}')
+    _, result = wall(f'import {script}', '-X', 'importtime')
+
+    # Children are listed before their parent: the script's own imports are
+    # the depth-1 lines right before its depth-0 line
+    imports, pending = [], []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if not match:
+            continue
+        depth = len(match.group(3)) // 2
+        if depth == 1:
+            pending.append((int(match.group(2)) / 1e6, match.group(4)))
+        elif depth == 0:
+            imports = pending if match.group(4) == script else imports
+            pending = []
+
+    verdict = "ok" if total <= STARTUP_TARGET else "over"
+    print(f"startup: {total * 1000:.1f}ms (interpreter {interpreter * 1000:.1f}ms), "
+          f"target {STARTUP_TARGET * 1000:.0f}ms: {verdict}")
+    for seconds, name in sorted(imports, reverse=True):
+        print(f"  {name:<28} {seconds * 1000:>7.1f}ms")
+    print("first use:")
+    for module in ('anthropic', 'openai', 'google.generativeai', 'tiktoken'):
+        elapsed, result = wall(f'import {module}')
+        cost = f"{(elapsed - interpreter) * 1000:>7.1f}ms" if result.returncode == 0 else "  not installed"
+        print(f"  {module:<28} {cost}")
+
+# BPE vocabulary per model family, matched by prefix. Claude's
+# tokenizer is not public; cl100k_base is the closest public vocabulary.
+ENCODINGS = {
+    'gpt-4o': 'o200k_base',
+    'o1': 'o200k_base',
+    'gpt': 'cl100k_base',
+    'chatgpt': 'cl100k_base',
+    'claude': 'cl100k_base',
+    'deepseek': 'cl100k_base',
+    'meta': 'cl100k_base',
+    'gemini': 'cl100k_base',
+}
+
+encoders = {}
 
-def token_count(input_text):
-    # Note: This is a simplified version since Python doesn't have the exact same tokenizer
-    return len(input_text.split())
+# tiktoken (optional) downloads a vocabulary on first use, with no timeout;
+# counting must not touch the network, so a vocabulary is only loaded when
+# it is already in tiktoken's cache. Fetch one once with
+#   python -c "import tiktoken; tiktoken.get_encoding('cl100k_base')"
+# Otherwise (or without tiktoken) counts are estimated.
+ENCODING_URL = "https://openaipublic.blob.core.windows.net/encodings/{}.tiktoken"
+
+def encoding_cached(name):
+    import tempfile
+    if "TIKTOKEN_CACHE_DIR" in os.environ:
+        cache_dir = os.environ["TIKTOKEN_CACHE_DIR"]
+    elif "DATA_GYM_CACHE_DIR" in os.environ:
+        cache_dir = os.environ["DATA_GYM_CACHE_DIR"]
+    else:
+        cache_dir = os.path.join(tempfile.gettempdir(), "data-gym-cache")
+    key = hashlib.sha1(ENCODING_URL.format(name).encode()).hexdigest()
+    return bool(cache_dir) and os.path.exists(os.path.join(cache_dir, key))
+
+def get_encoder(model):
+    model = MODELS.get(model, model) or ''
+    name = next((enc for prefix, enc in ENCODINGS.items() if model.startswith(prefix)), 'cl100k_base')
+    if name not in encoders:
+        encoders[name] = None
+        if encoding_cached(name):
+            try:
+                import tiktoken
+                encoders[name] = tiktoken.get_encoding(name)
+            except Exception:
+                pass
+    return name, encoders[name]
+
+# Without tiktoken: a word (with its leading space) costs one token per six
+# letters, a run of whitespace or a single symbol costs one. This mirrors how
+# BPE vocabularies split code closely enough for budgeting.
+ESTIMATE_PIECES = re.compile(r" ?[A-Za-z]+| ?\d{1,3}|\s+|[^\sA-Za-z\d]")
+
+def estimate_tokens(text):
+    count = 0
+    for piece in ESTIMATE_PIECES.findall(text):
+        word = piece.lstrip(' ')
+        count += (len(word) + 5) // 6 if word[:1].isalpha() else 1
+    return count
+
+# Texts are counted in chunks cut at blank lines, so that the boundaries only
+# move near an edit. Chunk counts are memoized: recounting a large file after
+# a local change only tokenizes the chunks that changed.
+CHUNK_BOUNDARY = re.compile(r"\n[ \t]*\n")
+CHUNK_MIN = 1024
+CHUNK_MAX = 16384
+CHUNK_MEMO_SIZE = 8192
+chunk_memo = OrderedDict()
+
+def token_chunks(text):
+    start = 0
+    for match in CHUNK_BOUNDARY.finditer(text):
+        end = match.end()
+        if end - start >= CHUNK_MIN:
+            yield from split_long(text[start:end])
+            start = end
+    if start < len(text):
+        yield from split_long(text[start:])
+
+def split_long(chunk):
+    while len(chunk) > CHUNK_MAX:
+        cut = chunk.rfind('\n', 0, CHUNK_MAX) + 1 or CHUNK_MAX
+        yield chunk[:cut]
+        chunk = chunk[cut:]
+    yield chunk
+
+def token_count(input_text, model=None):
+    name, encoder = get_encoder(model)
+    total = 0
+    for chunk in token_chunks(input_text):
+        # A digest, not the text: the daemon keeps the memo for its whole life
+        key = (name, hashlib.blake2b(chunk.encode('utf-8', 'surrogatepass'), digest_size=16).digest())
+        count = chunk_memo.get(key)
+        if count is None:
+            if encoder is not None:
+                count = len(encoder.encode(chunk, disallowed_special=()))
+            else:
+                count = estimate_tokens(chunk)
+            chunk_memo[key] = count
+            if len(chunk_memo) > CHUNK_MEMO_SIZE:
+                chunk_memo.popitem(last=False)
+        else:
+            chunk_memo.move_to_end(key)
+        total += count
+    return total
+
+# Sends one message to several models at once. "gather" waits for all of
+# them and returns, per model, its answer (or error) with timing and usage.
+# "race" returns the first answer that passes `accept` and cancels the rest.
+async def fanout(message, models, mode="gather", accept=None, asks=None, **kwargs):
+    asks = asks or {model: chat(model) for model in models}
+    kwargs.setdefault("on_text", lambda text: None)
+
+    async def run(model):
+        start = time.perf_counter()
+        try:
+            result = await asks[model](message, **{**kwargs, "model": model})
+            last = dict((await asks[model](None))['last'])
+            return {"model": model, "result": result, "error": None, "latency": last.get("latency"),
+                    "ttft": last.get("ttft"), "usage": last.get("usage"), "last": last}
+        except Exception as e:
+            return {"model": model, "result": None, "error": e, "latency": time.perf_counter() - start,
+                    "ttft": None, "usage": None, "last": {}}
+
+    tasks = [asyncio.create_task(run(model)) for model in models]
+    if mode == "gather":
+        return list(await asyncio.gather(*tasks))
+
+    pending = set(tasks)
+    errors = []
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                answer = task.result()
+                if answer["error"] is None and (accept is None or accept(answer["result"])):
+                    return answer
+                errors.append(f"{answer['model']}: {answer['error'] or 'answer not accepted'}")
+        raise RuntimeError("No acceptable answer (" + "; ".join(errors) + ")")
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+# A chat over several models ("c,cm,g") in race mode: each turn goes to all
+# of them, the first acceptable answer wins and becomes every model's history.
+def race_chat(models, accept=None):
+    asks = {model: chat(model) for model in models}
+    messages = []
+    last = {}
+
+    async def ask(user_message, on_text=echo, **kwargs):
+        if user_message is None:
+            return {'messages': messages, 'last': last}
+
+        for sub in asks.values():
+            (await sub(None))['messages'][:] = messages
+        answer = await fanout(user_message, models, "race", accept, asks, **kwargs)
+        messages[:] = (await asks[answer["model"]](None))['messages']
+        last.clear()
+        last.update(answer["last"])
+        on_text(answer["result"])
+        return answer["result"]
+
+    def on(event, handler):
+        for sub in asks.values():
+            sub.on(event, handler)
+
+    ask.on = on
+    return ask
+
+# Collects the events of the asks it is attached to into one span per call,
+# for a session summary or an export to JSONL (one span per line).
+class Trace:
+    def __init__(self):
+        self.spans = {}
+
+    def attach(self, ask):
+        for event in EVENTS:
+            ask.on(event, self.record)
+        return ask
+
+    def record(self, event):
+        span = self.spans.setdefault(event["id"], {
+            "id": event["id"], "model": event["model"], "chunks": 0, "chars": 0, "retries": 0, "skipped": 0,
+            "error": None})
+        kind = event["event"]
+        if kind == "start":
+            span.update(ts=event["ts"], messages=event["messages"])
+        elif kind == "first_token":
+            span["ttft"] = event["ttft"]
+        elif kind == "chunk":
+            span["chunks"] += 1
+            span["chars"] += len(event["text"])
+        elif kind == "retry":
+            span["retries"] = event["attempt"]
+        elif kind == "skipped":
+            span["skipped"] += 1
+        elif kind == "end":
+            last = event["last"]
+            span.update(ttft=last["ttft"], latency=last["latency"], queued=last["queued"], usage=last["usage"],
+                        cache_read=last["cache_read"], cache_write=last["cache_write"],
+                        saved_tokens=last["saved_tokens"])
+        elif kind == "error":
+            # A race's losers are cancelled, which is not a failure
+            cancelled = isinstance(event["error"], asyncio.CancelledError)
+            span.update(error=None if cancelled else repr(event["error"]), cancelled=cancelled,
+                        latency=event["latency"])
+
+    def summary(self):
+        spans = list(self.spans.values())
+        failed = sum(1 for span in spans if span["error"])
+        cancelled = sum(1 for span in spans if span.get("cancelled"))
+        retries = sum(span["retries"] for span in spans)
+        lines = [f"calls: {len(spans)} ({failed} failed, {cancelled} cancelled, {retries} retries)"]
+        lines.append(f"{'model':<36} {'calls':>5} {'ttft p50':>9} {'lat p50':>8} {'lat p95':>8} "
+                     f"{'in':>8} {'out':>7} {'cached':>8}")
+        for model in sorted({span["model"] for span in spans}):
+            group = [span for span in spans if span["model"] == model and "usage" in span]
+            ttfts = sorted(span["ttft"] for span in group if "ttft" in span) or [0.0]
+            latencies = sorted(span["latency"] for span in group) or [0.0]
+            usage = [span.get("usage") or {} for span in group]
+            lines.append(
+                f"{model:<36} {len(group):>5} {ttfts[len(ttfts) // 2]:>8.2f}s "
+                f"{latencies[len(latencies) // 2]:>7.2f}s {latencies[int(len(latencies) * 0.95)]:>7.2f}s "
+                f"{sum(u.get('input_tokens') or 0 for u in usage):>8} "
+                f"{sum(u.get('output_tokens') or 0 for u in usage):>7} "
+                f"{sum(span.get('cache_read') or 0 for span in group):>8}")
+        return "\n".join(lines)
+
+    def export(self, path):
+        path = Path(path).expanduser()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'a', encoding='utf-8') as f:
+            for span in self.spans.values():
+                f.write(json.dumps(span, default=str) + "\n")
+
+    # --trace prints the summary; --trace=FILE also appends the spans to FILE
+    def report(self, path=None):
+        print(self.summary())
+        if isinstance(path, str):
+            self.export(path)
+
+# Provider SDKs are imported on first use: the anthropic and openai packages
+# (with httpx and pydantic) take longer to import than everything else the
+# tools load at startup.
+def require(module, package):
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        raise ImportError(f"This model needs the {package} package (pip install {package})") from None
 
 def chat(model):
+    if ',' in model:
+        return race_chat([MODELS.get(m, m) for m in model.split(',')])
     model = MODELS.get(model, model)
     if model.startswith('gpt'):
-        return openai_chat(openai.OpenAI, model)
+        return openai_chat(require('openai', 'openai').AsyncOpenAI, model)
     elif model.startswith('o1'):
-        return openai_chat(openai.OpenAI, model)
+        return openai_chat(require('openai', 'openai').AsyncOpenAI, model)
     elif model.startswith('chatgpt'):
-        return openai_chat(openai.OpenAI, model)
+        return openai_chat(require('openai', 'openai').AsyncOpenAI, model)
     elif model.startswith('deepseek'):
-        return openai_chat(openai.OpenAI, model)
+        return openai_chat(require('openai', 'openai').AsyncOpenAI, model, "deepseek", "https://api.deepseek.com")
     elif model.startswith('claude'):
-        return anthropic_chat(Anthropic, model)
+        return anthropic_chat(require('anthropic', 'anthropic').AsyncAnthropic, model)
     elif model.startswith('meta'):
-        return openai_chat(OpenRouter, model)
+        return openai_chat(require('openai', 'openai').AsyncOpenAI, model, "openrouter", "https://openrouter.ai/api/v1")
     elif model.startswith('gemini'):
-        return gemini_chat(genai, model)
+        return gemini_chat(require('google.generativeai', 'google-generativeai'), model)
+    elif model.startswith('local'):
+        return local_chat(model)
+    elif model.startswith('mock'):
+        return mock_chat(model)
     else:
         raise ValueError(f"Unsupported model: {model}")
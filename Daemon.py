@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import importlib
+import contextvars
+from pathlib import Path
+
+from Chat import chat, echo, split_flags, EVENTS
+
+# Long-lived local server that keeps provider SDKs imported, API clients
+# (and their TLS connections) open, and holefill's import and token caches
+# warm between invocations. holefill and chatsh use it when it runs and work
+# in-process when it does not; AI_DAEMON=0 keeps them in-process.
+#
+# The protocol is one JSON object per line over a Unix socket. A request
+# names a tool:
+#   {"tool": "holefill", "argv": [...], "cwd": "..."}
+#       -> {"out": text}... then {"exit": code}
+#   {"tool": "ask", "model": ..., "messages": [...], "message": ..., "options": {...}}
+#       -> {"text": chunk} and {"event": {...}}... then
+#          {"result": ..., "messages": [...], "last": {...}} or {"error": ...}
+#   {"tool": "stop"}
+
+SOCKET_PATH = Path(os.environ.get('AI_SOCKET') or Path.home() / '.ai' / 'daemon.sock')
+PRELOAD = ('anthropic', 'openai', 'tiktoken')
+
+def usage():
+    print("Usage: Daemon.py [--stop]")
+    print("")
+    print(f"Serves holefill and chatsh requests on {SOCKET_PATH} until stopped.")
+    sys.exit(1)
+
+# Whatever a tool prints goes to the client that ran it: sys.stdout is
+# replaced by a proxy that writes to the current request's output.
+output = contextvars.ContextVar('output', default=None)
+
+class OutputProxy:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        return (output.get() or self.stream).write(text)
+
+    def flush(self):
+        (output.get() or self.stream).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class RequestOutput:
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, text):
+        if text:
+            send(self.writer, {"out": text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+def send(writer, message):
+    writer.write(json.dumps(message, default=str).encode('utf-8') + b"\n")
+
+async def run_holefill(request, writer):
+    import holefill
+    from History import logs
+    token = output.set(RequestOutput(writer))
+    try:
+        await holefill.main(request["argv"], request["cwd"])
+        code = 0
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 0 if e.code is None else 1
+    except Exception as e:
+        print(f"Error: {e}")
+        code = 1
+    finally:
+        output.reset(token)
+        for log in logs:
+            log.flush()
+    send(writer, {"exit": code})
+
+async def run_ask(request, writer):
+    ask = chat(request["model"])
+
+    def forward(event):
+        send(writer, {"event": {**event, "error": repr(event["error"])} if "error" in event else event})
+
+    for event in EVENTS:
+        if event != "chunk":
+            ask.on(event, forward)
+    (await ask(None))['messages'][:] = request["messages"]
+    try:
+        result = await ask(request["message"], on_text=lambda text: send(writer, {"text": text}),
+                           **request["options"])
+    except (Exception, SystemExit) as e:
+        return send(writer, {"error": f"{type(e).__name__}: {e}"})
+    state = await ask(None)
+    send(writer, {"result": result, "messages": state['messages'], "last": state['last']})
+
+async def handle(reader, writer):
+    try:
+        request = json.loads(await reader.readline() or b"{}")
+        tool = request.get("tool")
+        if tool == "stop":
+            send(writer, {"exit": 0})
+            asyncio.get_running_loop().call_soon(stopping.set)
+            return
+        if tool == "holefill":
+            task = asyncio.create_task(run_holefill(request, writer))
+        elif tool == "ask":
+            task = asyncio.create_task(run_ask(request, writer))
+        else:
+            return send(writer, {"error": f"Unknown tool: {tool}"})
+        # A client that hangs up (Ctrl-C, a discarded prefetch) cancels its request
+        hangup = asyncio.create_task(reader.read())
+        done, _ = await asyncio.wait([task, hangup], return_when=asyncio.FIRST_COMPLETED)
+        if task not in done:
+            task.cancel()
+        hangup.cancel()
+        await asyncio.gather(task, hangup, return_exceptions=True)
+        await writer.drain()
+    except (ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+stopping = None
+
+async def serve():
+    global stopping
+    stopping = asyncio.Event()
+    for module in PRELOAD:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+    sys.stdout = OutputProxy(sys.stdout)
+
+    SOCKET_PATH.parent.mkdir(parents=True, exist_ok=True)
+    if daemon_running():
+        print(f"A daemon already listens on {SOCKET_PATH}")
+        sys.exit(1)
+    SOCKET_PATH.unlink(missing_ok=True)
+    # Whoever can connect runs tools as this user: the socket is created
+    # private, not made private after the fact
+    umask = os.umask(0o077)
+    try:
+        server = await asyncio.start_unix_server(handle, str(SOCKET_PATH))
+    finally:
+        os.umask(umask)
+    print(f"Daemon listening on {SOCKET_PATH}")
+    try:
+        async with server:
+            await stopping.wait()
+    finally:
+        SOCKET_PATH.unlink(missing_ok=True)
+        from Chat import aclose_clients
+        await aclose_clients()
+
+def connect_socket():
+    if os.environ.get('AI_DAEMON') == '0':
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(SOCKET_PATH))
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+def daemon_running():
+    sock = connect_socket()
+    if sock:
+        sock.close()
+    return sock is not None
+
+# Runs a tool in the daemon, printing its output as it comes. Returns its
+# exit code, or None when no daemon runs.
+def run_remote(tool, argv):
+    sock = connect_socket()
+    if sock is None:
+        return None
+    with sock, sock.makefile('rb') as lines:
+        sock.sendall(json.dumps({"tool": tool, "argv": argv, "cwd": os.getcwd()}).encode('utf-8') + b"\n")
+        for line in lines:
+            message = json.loads(line)
+            if "out" in message:
+                sys.stdout.write(message["out"])
+                sys.stdout.flush()
+            elif "exit" in message:
+                return message["exit"]
+    print("Error: the daemon closed the connection")
+    return 1
+
+# A chat whose requests are made by the daemon, with the conversation kept
+# here. Works like the ask of make_chat (callable options such as `shorten`
+# cannot cross the socket), and falls back to an in-process chat if the
+# daemon goes away.
+def remote_chat(MODEL):
+    messages = []
+    last = {}
+    hooks = {event: [] for event in EVENTS}
+    local = None
+
+    def on(event, handler):
+        if event not in hooks:
+            raise ValueError(f"Unknown event: {event}")
+        hooks[event].append(handler)
+        if local:
+            local.on(event, handler)
+
+    async def ask(user_message, on_text=echo, **options):
+        nonlocal local
+        if user_message is None:
+            return {'messages': messages, 'last': last}
+
+        try:
+            reader, writer = await asyncio.open_unix_connection(str(SOCKET_PATH))
+        except OSError:
+            if local is None:
+                local = chat(MODEL)
+                for event, handlers in hooks.items():
+                    for handler in handlers:
+                        local.on(event, handler)
+            state = await local(None)
+            state['messages'][:] = messages
+            result = await local(user_message, on_text=on_text, **options)
+            messages[:] = state['messages']
+            last.clear()
+            last.update(state['last'])
+            return result
+
+        # The call as the daemon's events describe it; a call that ends
+        # without its "end" or "error" event (cancelled here, or the daemon
+        # died) gets its "error" event here
+        call = {"id": None, "model": MODEL, "settled": False}
+        start = time.perf_counter()
+        try:
+            request = {"tool": "ask", "model": options.pop("model", None) or MODEL, "messages": messages,
+                       "message": user_message, "options": options}
+            writer.write(json.dumps(request).encode('utf-8') + b"\n")
+            await writer.drain()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    raise ConnectionError("the daemon closed the connection")
+                message = json.loads(line)
+                if "text" in message:
+                    for handler in hooks["chunk"]:
+                        handler({"event": "chunk", "id": call["id"], "model": call["model"],
+                                 "time": time.perf_counter(), "text": message["text"]})
+                    on_text(message["text"])
+                elif "event" in message:
+                    event = message["event"]
+                    call.update(id=event["id"], model=event["model"], settled=event["event"] in ("end", "error"))
+                    for handler in hooks[event["event"]]:
+                        handler(event)
+                elif "error" in message:
+                    raise RuntimeError(message["error"])
+                else:
+                    messages[:] = message["messages"]
+                    last.clear()
+                    last.update(message["last"])
+                    return message["result"]
+        except BaseException as e:
+            if call["id"] is not None and not call["settled"]:
+                for handler in hooks["error"]:
+                    handler({"event": "error", "id": call["id"], "model": call["model"], "time": time.perf_counter(),
+                             "error": e, "latency": time.perf_counter() - start})
+            raise
+        finally:
+            writer.close()
+
+    ask.on = on
+    return ask
+
+def connect(model):
+    return remote_chat(model) if daemon_running() else chat(model)
+
+async def stop():
+    reader, writer = await asyncio.open_unix_connection(str(SOCKET_PATH))
+    send(writer, {"tool": "stop"})
+    await writer.drain()
+    await reader.readline()
+    writer.close()
+
+if __name__ == "__main__":
+    args, flags = split_flags(sys.argv[1:])
+    if args or flags.get("help"):
+        usage()
+    if flags.get("stop"):
+        if not daemon_running():
+            print("No daemon is running.")
+            sys.exit(1)
+        asyncio.run(stop())
+    else:
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,378 @@
+import os
+import re
+import sys
+import signal
+import json
+import time
+import atexit
+import hashlib
+from pathlib import Path
+from datetime import datetime
+
+from Splice import write_all
+
+AI_DIR = Path.home() / '.ai'
+CHATSH_LOG = AI_DIR / 'chatsh_history' / 'chatsh.jsonl'
+HOLEFILL_LOG = AI_DIR / 'prompt_history' / 'holefill.jsonl'
+
+# A log is rotated (and the old part gzipped) once it grows past this size
+LOG_MAX_BYTES = 8 * 1024 * 1024
+# Seconds a record may sit in the write buffer, and how much it may hold
+FLUSH_INTERVAL = 2.0
+LOG_BUFFER_BYTES = 64 * 1024
+
+logs = []
+
+# Append-only JSONL log, buffered in memory. Every record carries a
+# timestamp and the id of the session that wrote it. Many processes append
+# to one log (every chatsh session, holefill runs, the daemon): a flush holds
+# an flock on the file, checks that the path still names the file it has
+# open (reopening it if another writer rotated it), and writes each record
+# with a single write to an O_APPEND descriptor, so records never interleave.
+class Log:
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, flush_interval=FLUSH_INTERVAL):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.session = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+        self.fd = None
+        self.buffer = []
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+        logs.append(self)
+
+    def open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def write(self, **fields):
+        record = {"ts": datetime.now().isoformat(timespec='milliseconds'), "session": self.session, **fields}
+        data = (json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8')
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= LOG_BUFFER_BYTES or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    # Opens the log and locks it, until the file locked is the one the path
+    # names: a writer that rotated it in the meantime released a file that
+    # is no longer the log
+    def lock(self):
+        import fcntl
+        while True:
+            if self.fd is None:
+                self.open()
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self.fd).st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            self.close()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return
+        import fcntl
+        self.lock()
+        try:
+            for data in self.buffer:
+                written = os.write(self.fd, data)
+                if written < len(data):
+                    # Only on a full disk or the like; still under the lock
+                    write_all(self.fd, data[written:])
+            self.buffer, self.buffered = [], 0
+            rotated = os.fstat(self.fd).st_size >= self.max_bytes and self.rotate()
+        finally:
+            if self.fd is not None:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        if rotated:
+            compress(rotated)
+
+    # Called with the lock held: renames the log away and closes it, so that
+    # the next write starts a new one. Returns the renamed file.
+    def rotate(self):
+        stamp = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+        rotated = self.path.with_name(f"{self.path.stem}-{stamp}{self.path.suffix}")
+        os.rename(self.path, rotated)
+        self.close()
+        return rotated
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def compress(rotated):
+    import gzip
+    import shutil
+    with open(rotated, 'rb') as src, gzip.open(f"{rotated}.gz", 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(rotated)
+
+def flush_logs():
+    for log in logs:
+        log.flush()
+        log.close()
+
+atexit.register(flush_logs)
+
+# SIGTERM and SIGHUP (a closed terminal) would end the process without
+# running atexit, losing what is still buffered: they exit normally instead,
+# unless the program handles them itself
+def exit_on_signal(signum, frame):
+    sys.exit(128 + signum)
+
+for signum in (signal.SIGTERM, signal.SIGHUP):
+    if signal.getsignal(signum) == signal.SIG_DFL:
+        signal.signal(signum, exit_on_signal)
+
+# Conversation state of chatsh sessions, so that one can be resumed. Each
+# session is a JSONL file of records: {"message": ...} adds a message, and
+# {"model": ...}, {"output": ...} (the last command output) and {"cwd": ...}
+# set the rest of the state. A turn appends to it; a conversation that
+# changed other than by growing (compacted, or a prefetch undone) is
+# rewritten whole.
+SESSIONS_DIR = AI_DIR / 'chatsh_sessions'
+
+class Session:
+    def __init__(self, id, directory=SESSIONS_DIR):
+        self.id = id
+        self.path = Path(directory) / f"{id}.jsonl"
+        self.model = None
+        self.messages = []
+        self.output = ""
+        self.cwd = None
+        # The messages as the file has them
+        self.saved = []
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            lines = f.read().splitlines()
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A record cut short by a crash
+                continue
+            if "message" in record:
+                self.messages.append(record["message"])
+            for field in ("model", "output", "cwd"):
+                if field in record:
+                    setattr(self, field, record[field])
+        self.saved = list(self.messages)
+        return self
+
+    def save(self, messages, output="", model=None, cwd=None):
+        state = [{field: value} for field, value in (("model", model), ("output", output), ("cwd", cwd))
+                 if value != getattr(self, field)]
+        count = len(self.saved)
+        if messages[:count] == self.saved:
+            records, mode = [{"message": message} for message in messages[count:]] + state, 'a'
+        else:
+            records, mode = ([{"model": model, "output": output, "cwd": cwd}] +
+                             [{"message": message} for message in messages]), 'w'
+        if records:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(f".{self.path.name}.tmp") if mode == 'w' else self.path
+            with open(tmp, mode, encoding='utf-8') as f:
+                f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+            if mode == 'w':
+                os.replace(tmp, self.path)
+        self.model, self.output, self.cwd = model, output, cwd
+        self.messages = self.saved = list(messages)
+
+# The session `id` (or the one session whose id starts with it), or the
+# latest one; None if there is no such session.
+def find_session(id=None, directory=SESSIONS_DIR):
+    if not directory.exists():
+        return None
+    entries = [entry for entry in os.scandir(directory) if entry.name.endswith('.jsonl')]
+    if id:
+        entries = [entry for entry in entries if entry.name == f"{id}.jsonl"] or \
+                  [entry for entry in entries if entry.name.startswith(id)]
+        if len(entries) != 1:
+            return None
+    if not entries:
+        return None
+    latest = max(entries, key=lambda entry: entry.stat().st_mtime)
+    return Session(latest.name[:-len('.jsonl')], directory).load()
+
+# Search index over every log under ~/.ai: the JSONL logs (live and rotated)
+# and the older one-file-per-entry .log/.txt histories. Sources are indexed
+# incrementally: live logs from the last indexed offset, other files once.
+INDEX_PATH = AI_DIR / 'history.db'
+HISTORY_DIRS = [AI_DIR / 'chatsh_history', AI_DIR / 'prompt_history']
+
+INDEX_SCHEMA = '''
+create table if not exists sources (path text primary key, mtime real, size integer, offset integer, ino integer, head text);
+create table if not exists entries (
+    id integer primary key, key text unique, ts text, tool text, role text,
+    model text, file text, prompt_hash text, prompt text, reply text);
+create index if not exists entries_prompt_hash on entries (prompt_hash);
+create index if not exists entries_ts on entries (ts);
+create index if not exists entries_file on entries (file);
+create virtual table if not exists entries_text using fts5 (prompt, reply);
+'''
+
+def prompt_hash(prompt):
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest() if prompt else None
+
+def open_index(path=INDEX_PATH):
+    import sqlite3
+    path.parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(path)
+    db.executescript(INDEX_SCHEMA)
+    # Indexes made before sources had these columns
+    columns = [row[1] for row in db.execute('pragma table_info(sources)')]
+    for column, kind in (('ino', 'integer'), ('head', 'text')):
+        if column not in columns:
+            db.execute(f'alter table sources add column {column} {kind}')
+    return db
+
+def add_entry(db, key, ts, tool, role, model=None, file=None, prompt=None, reply=None):
+    cursor = db.execute(
+        'insert or ignore into entries (key, ts, tool, role, model, file, prompt_hash, prompt, reply) '
+        'values (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (key, ts, tool, role, model, file, prompt_hash(prompt), prompt, reply))
+    if cursor.rowcount:
+        db.execute('insert into entries_text (rowid, prompt, reply) values (?, ?, ?)',
+                   (cursor.lastrowid, prompt or '', reply or ''))
+
+def index_records(db, path, lines):
+    tool = 'holefill' if path.parent.name == 'prompt_history' else 'chatsh'
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        key = hashlib.sha1(line.encode('utf-8') if isinstance(line, str) else line).hexdigest()
+        if tool == 'holefill':
+            add_entry(db, key, record.get('ts'), tool, 'completion', record.get('model'), record.get('file'),
+                      record.get('prompt'), record.get('reply'))
+        elif record.get('role') == 'ChatSH':
+            add_entry(db, key, record.get('ts'), tool, 'ChatSH', record.get('model'), None,
+                      record.get('prompt'), record.get('text'))
+        else:
+            add_entry(db, key, record.get('ts'), tool, record.get('role'), record.get('model'), None,
+                      record.get('text'), None)
+
+def index_legacy(db, path, stat):
+    text = path.read_text(encoding='utf-8', errors='replace')
+    ts = datetime.fromtimestamp(stat.st_mtime).isoformat(timespec='milliseconds')
+    if path.suffix == '.log':
+        match = re.match(r"SYSTEM:\n[\s\S]*?\n\nPROMPT:\n([\s\S]*?)\n\nREPLY:\n([\s\S]*?)\n\n$", text)
+        if match:
+            model = path.stem.split('_', 1)[-1]
+            add_entry(db, str(path), ts, 'holefill', 'completion', model, None, match.group(1), match.group(2))
+        return
+    prompt = None
+    for i, match in enumerate(re.finditer(r"<(\w+)>\n([\s\S]*?)\n</\1>\n\n", text)):
+        role, message = match.groups()
+        if role == 'ChatSH':
+            add_entry(db, f"{path}#{i}", ts, 'chatsh', role, None, None, prompt, message)
+        else:
+            add_entry(db, f"{path}#{i}", ts, 'chatsh', role, None, None, message, None)
+            prompt = message if role == 'USER' else prompt
+
+def refresh_index(db, dirs=HISTORY_DIRS):
+    for log in logs:
+        log.flush()
+    known = {row[0]: row[1:] for row in db.execute('select path, mtime, size, offset, ino, head from sources')}
+    for directory in dirs:
+        if not directory.exists():
+            continue
+        for entry in os.scandir(directory):
+            path = Path(entry.path)
+            if not entry.name.endswith(('.jsonl', '.jsonl.gz', '.log', '.txt')):
+                continue
+            stat = entry.stat()
+            mtime, size, offset, ino, head = known.get(entry.path, (None, None, 0, None, None))
+            if mtime == stat.st_mtime and size == stat.st_size and ino == stat.st_ino:
+                continue
+            if entry.name.endswith('.jsonl'):
+                # Live log: read what was appended since last time. A file
+                # that is another one than last time was rotated, and is
+                # read from the start; rotated records come back deduplicated.
+                # Its first record tells it apart where its inode was reused.
+                with open(path, 'rb') as f:
+                    first = hashlib.sha1(f.readline()).hexdigest()
+                    if stat.st_size < offset or ino != stat.st_ino or head != first:
+                        offset = 0
+                    head = first
+                    f.seek(offset)
+                    data = f.read()
+                complete = data[:data.rfind(b'\n') + 1]
+                index_records(db, path, complete.decode('utf-8', errors='replace').splitlines())
+                offset += len(complete)
+            elif entry.name.endswith('.jsonl.gz'):
+                import gzip
+                with gzip.open(path, 'rt', encoding='utf-8', errors='replace') as f:
+                    index_records(db, path.with_suffix(''), f.read().splitlines())
+            else:
+                index_legacy(db, path, stat)
+            db.execute('insert or replace into sources (path, mtime, size, offset, ino, head) values (?, ?, ?, ?, ?, ?)',
+                       (entry.path, stat.st_mtime, stat.st_size, offset, stat.st_ino, head))
+    db.commit()
+
+def search(text=None, model=None, since=None, until=None, file=None, tool=None, limit=20):
+    db = open_index()
+    try:
+        refresh_index(db)
+        query = 'select e.id, e.ts, e.tool, e.role, e.model, e.file, e.prompt, e.reply from entries e'
+        where, args = [], []
+        if text:
+            query += ' join entries_text t on t.rowid = e.id'
+            where.append('entries_text match ?')
+            args.append(' '.join('"%s"' % term.replace('"', '""') for term in text.split()))
+        for clause, value in [('e.model like ?', model and f"%{model}%"), ('e.ts >= ?', since),
+                              ('e.ts < ?', until), ('e.file like ?', file and f"%{file}%"),
+                              ('e.tool = ?', tool)]:
+            if value:
+                where.append(clause)
+                args.append(value)
+        if where:
+            query += ' where ' + ' and '.join(where)
+        query += ' order by e.ts desc limit ?'
+        columns = ['id', 'ts', 'tool', 'role', 'model', 'file', 'prompt', 'reply']
+        return [dict(zip(columns, row)) for row in db.execute(query, args + [limit])]
+    finally:
+        db.close()
+
+def get_entry(id):
+    db = open_index()
+    try:
+        row = db.execute('select id, ts, tool, role, model, file, prompt, reply from entries where id = ?', (id,)).fetchone()
+        columns = ['id', 'ts', 'tool', 'role', 'model', 'file', 'prompt', 'reply']
+        return dict(zip(columns, row)) if row else None
+    finally:
+        db.close()
+
+# Latest reply previously given to exactly this prompt
+def find_reply(prompt, model=None, tool=None):
+    db = open_index()
+    try:
+        refresh_index(db)
+        query = 'select reply from entries where prompt_hash = ? and reply is not null'
+        args = [prompt_hash(prompt)]
+        if model:
+            query += ' and model = ?'
+            args.append(model)
+        if tool:
+            query += ' and tool = ?'
+            args.append(tool)
+        row = db.execute(query + ' order by ts desc limit 1', args).fetchone()
+        return row[0] if row else None
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    flags = dict(arg[2:].partition('=')[::2] for arg in sys.argv[1:] if arg.startswith('--'))
+    if not args and not flags:
+        print("Usage: History.py [--model=M] [--since=DATE] [--until=DATE] [--file=PATH] [--tool=chatsh|holefill] [<text>...]")
+        sys.exit(1)
+    for row in search(' '.join(args), flags.get('model'), flags.get('since'), flags.get('until'),
+                      flags.get('file'), flags.get('tool'), int(flags.get('limit', 20))):
+        snippet = (row['reply'] or row['prompt'] or '').strip().replace('\n', ' ')[:100]
+        print(f"{row['id']:>6} {row['ts'][:19]} {row['tool']:<8} {row['model'] or '-':<28} {snippet}")
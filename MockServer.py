@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+import sys
+import json
+import time
+import asyncio
+
+# Local stand-in for the Anthropic and OpenAI HTTP APIs, replaying a canned
+# reply with configurable latency. Point the tools at it with
+#   AI_LOCAL_URL=http://127.0.0.1:8765          (model "local")
+#   ANTHROPIC_BASE_URL=http://127.0.0.1:8765    (claude models)
+#   OPENAI_BASE_URL=http://127.0.0.1:8765/v1    (gpt models)
+
+DEFAULT_PORT = 8765
+DEFAULT_REPLY = "<COMPLETION>mock</COMPLETION>"
+
+def usage():
+    print("Usage: MockServer.py [--port=N] [--ttft=SECONDS] [--latency=SECONDS] [--max-concurrent=N]")
+    print("                     [--reply=TEXT | --reply-file=PATH]")
+    print("")
+    print("Serves /v1/messages (Anthropic) and /v1/chat/completions (OpenAI).")
+    print("Every reply takes --ttft seconds to its first token and --latency in total.")
+    print("Past --max-concurrent requests in flight, it answers 429 with a retry-after.")
+    sys.exit(1)
+
+def split_words(text):
+    words = text.split(' ')
+    return [word + ' ' for word in words[:-1]] + [words[-1]]
+
+class MockServer:
+    def __init__(self, reply=DEFAULT_REPLY, ttft=0.0, latency=0.0, max_concurrent=None):
+        self.reply = reply
+        self.ttft = ttft
+        self.latency = latency
+        self.max_concurrent = max_concurrent
+        self.requests = 0
+        self.in_flight = 0
+        self.rejected = 0
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=DEFAULT_PORT):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b""):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                self.requests += 1
+                if self.max_concurrent and self.in_flight >= self.max_concurrent:
+                    self.rejected += 1
+                    await self.send_json(writer, 429, {"error": {"type": "rate_limit_error", "message": "slow down"}},
+                                         {"retry-after": f"{max(self.latency, 0.01):g}"})
+                else:
+                    self.in_flight += 1
+                    try:
+                        await self.respond(writer, method, path.split('?')[0], json.loads(body or b"{}"))
+                    finally:
+                        self.in_flight -= 1
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, method, path, request):
+        if method != 'POST' or path not in ('/v1/messages', '/v1/chat/completions'):
+            return await self.send_json(writer, 404, {"error": {"message": f"no route {path}"}})
+        anthropic = path == '/v1/messages'
+        input_tokens = len(json.dumps(request.get("messages", []))) // 4
+        output_tokens = len(self.reply) // 4
+        words = split_words(self.reply)
+
+        if not request.get("stream"):
+            await asyncio.sleep(self.latency)
+            if anthropic:
+                payload = {"id": "msg_mock", "type": "message", "role": "assistant", "model": request.get("model"),
+                           "content": [{"type": "text", "text": self.reply}], "stop_reason": "end_turn",
+                           "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens}}
+            else:
+                payload = {"id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()),
+                           "model": request.get("model"),
+                           "choices": [{"index": 0, "message": {"role": "assistant", "content": self.reply},
+                                        "finish_reason": "stop"}],
+                           "usage": {"prompt_tokens": input_tokens, "completion_tokens": output_tokens,
+                                     "total_tokens": input_tokens + output_tokens}}
+            return await self.send_json(writer, 200, payload)
+
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+        await asyncio.sleep(self.ttft)
+        gap = max(self.latency - self.ttft, 0) / max(len(words) - 1, 1)
+        if anthropic:
+            await self.send_event(writer, "message_start", {"type": "message_start", "message": {
+                "id": "msg_mock", "type": "message", "role": "assistant", "model": request.get("model"),
+                "content": [], "stop_reason": None, "stop_sequence": None,
+                "usage": {"input_tokens": input_tokens, "output_tokens": 1}}})
+            await self.send_event(writer, "content_block_start", {"type": "content_block_start", "index": 0,
+                                                                  "content_block": {"type": "text", "text": ""}})
+            for i, word in enumerate(words):
+                if i:
+                    await asyncio.sleep(gap)
+                await self.send_event(writer, "content_block_delta", {"type": "content_block_delta", "index": 0,
+                                                                      "delta": {"type": "text_delta", "text": word}})
+            await self.send_event(writer, "content_block_stop", {"type": "content_block_stop", "index": 0})
+            await self.send_event(writer, "message_delta", {"type": "message_delta",
+                                                            "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                                            "usage": {"output_tokens": output_tokens}})
+            await self.send_event(writer, "message_stop", {"type": "message_stop"})
+        else:
+            base = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()),
+                    "model": request.get("model")}
+            for i, word in enumerate(words):
+                if i:
+                    await asyncio.sleep(gap)
+                await self.send_event(writer, None, {**base, "choices": [{"index": 0, "delta": {"content": word},
+                                                                          "finish_reason": None}]})
+            await self.send_event(writer, None, {**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            if (request.get("stream_options") or {}).get("include_usage"):
+                await self.send_event(writer, None, {**base, "choices": [], "usage": {
+                    "prompt_tokens": input_tokens, "completion_tokens": output_tokens,
+                    "total_tokens": input_tokens + output_tokens}})
+            await self.send_chunk(writer, b"data: [DONE]\n\n")
+        await self.send_chunk(writer, b"")
+
+    async def send_json(self, writer, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        extra = "".join(f"{name}: {value}\r\n" for name, value in (headers or {}).items())
+        writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n{extra}"
+                     f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode('latin-1') + body)
+        await writer.drain()
+
+    async def send_event(self, writer, event, data):
+        text = (f"event: {event}\n" if event else "") + f"data: {json.dumps(data)}\n\n"
+        await self.send_chunk(writer, text.encode('utf-8'))
+
+    async def send_chunk(self, writer, data):
+        writer.write(f"{len(data):x}\r\n".encode('latin-1') + data + b"\r\n")
+        await writer.drain()
+
+async def main():
+    args = dict(arg[2:].partition('=')[::2] for arg in sys.argv[1:] if arg.startswith('--'))
+    if 'help' in args:
+        usage()
+    reply = args.get('reply', DEFAULT_REPLY)
+    if 'reply-file' in args:
+        with open(args['reply-file'], 'r', encoding='utf-8') as f:
+            reply = f.read()
+    server = MockServer(reply, float(args.get('ttft', 0)), float(args.get('latency', 0)),
+                        int(args.get('max-concurrent', 0)) or None)
+    port = await server.start(port=int(args.get('port', DEFAULT_PORT)))
+    print(f"MockServer listening on http://127.0.0.1:{port}")
+    await server.server.serve_forever()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,164 @@
+import os
+import mmap
+import stat
+import tempfile
+from pathlib import Path
+
+# Writes replacements back into files that may be large and may be edited
+# while a request is in flight. Files are read through mmap and written to a
+# temp file next to them (unchanged byte ranges copied by the kernel where it
+# can), fsynced and renamed over the original, so a crash leaves either the
+# old file or the new one. A snapshot taken when the file was read tells
+# whether it changed since; if so, each hole is found again by the bytes
+# around it instead of by its old offset.
+
+# Bytes kept on each side of a hole to find it again
+CONTEXT_BYTES = 64
+COPY_CHUNK = 1024 * 1024
+copy_file_range = getattr(os, 'copy_file_range', None)
+
+def open_map(f):
+    # mmap cannot map an empty file
+    if os.fstat(f.fileno()).st_size == 0:
+        return b""
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def find_all(data, marker):
+    offsets = []
+    pos = data.find(marker)
+    while pos != -1:
+        offsets.append(pos)
+        pos = data.find(marker, pos + len(marker))
+    return offsets
+
+def snapshot(path, marker=None):
+    path = Path(path)
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        snap = {"path": path, "ino": st.st_ino, "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                "marker": marker, "holes": []}
+        if marker:
+            data = open_map(f)
+            for offset in find_all(data, marker):
+                end = offset + len(marker)
+                snap["holes"].append((offset, bytes(data[max(offset - CONTEXT_BYTES, 0):offset]),
+                                      bytes(data[end:end + CONTEXT_BYTES])))
+            if isinstance(data, mmap.mmap):
+                data.close()
+    return snap
+
+def changed(snap, st=None):
+    try:
+        st = st or os.stat(snap["path"])
+    except FileNotFoundError:
+        return True
+    return (st.st_ino, st.st_size, st.st_mtime_ns) != (snap["ino"], snap["size"], snap["mtime_ns"])
+
+# Where hole `i` of the snapshot is now, or None. An edit elsewhere leaves
+# it, with its context, at its old offset (edit after it) or moved by the
+# change in size (edit before it); otherwise it is the one place its context,
+# or one side of it if that was edited, still matches.
+def locate(data, snap, i):
+    marker = snap["marker"]
+    offset, before, after = snap["holes"][i]
+    whole = before + marker + after
+    for candidate in (offset, offset + len(data) - snap["size"]):
+        start = candidate - len(before)
+        if start >= 0 and data[start:start + len(whole)] == whole:
+            return candidate
+    for needle, shift in ((whole, len(before)), (before + marker, len(before)), (marker + after, 0)):
+        first = data.find(needle)
+        if first != -1 and data.find(needle, first + 1) == -1:
+            return first + shift
+    return None
+
+def copy_range(src, dst, start, count):
+    global copy_file_range
+    while count > 0:
+        copied = 0
+        if copy_file_range:
+            try:
+                copied = copy_file_range(src.fileno(), dst, count, start)
+            except OSError:
+                # Not across these filesystems: copy through user space
+                copy_file_range = None
+        if not copied:
+            src.seek(start)
+            data = src.read(min(count, COPY_CHUNK))
+            if not data:
+                raise EOFError(f"{src.name} ended at byte {start}")
+            write_all(dst, data)
+            copied = len(data)
+        start += copied
+        count -= copied
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+# Replaces `path` by its content with `edits` (sorted, non-overlapping
+# (start, end, bytes) ranges) applied. The ranges are offsets in `src`, the
+# already open file they were computed from, if given.
+def write_atomic(path, edits, src=None):
+    # A symlink stays a symlink: the file it points to is replaced
+    path = Path(os.path.realpath(path))
+    source = src or open(path, 'rb')
+    try:
+        st = os.fstat(source.fileno())
+        # A name of its own: the daemon may write the same file twice at once
+        fd, tmp = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+        try:
+            os.fchmod(fd, stat.S_IMODE(st.st_mode))
+            pos = 0
+            for start, end, data in edits:
+                copy_range(source, fd, pos, start - pos)
+                write_all(fd, data)
+                pos = min(end, st.st_size)
+            copy_range(source, fd, pos, st.st_size - pos)
+            os.fsync(fd)
+        except BaseException:
+            os.close(fd)
+            os.remove(tmp)
+            raise
+        os.close(fd)
+    finally:
+        if src is None:
+            source.close()
+    os.replace(tmp, path)
+    directory = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+# Writes `replacements[i]` (bytes, or None to leave it) over hole i of the
+# snapshot. Returns the indexes of the holes that could not be placed,
+# because the file changed around them.
+def splice_holes(snap, replacements):
+    marker = snap["marker"]
+    conflicts = []
+    with open(snap["path"], 'rb') as f:
+        data = open_map(f)
+        try:
+            moved = changed(snap, os.fstat(f.fileno()))
+            edits = []
+            taken = set()
+            for i, replacement in enumerate(replacements):
+                if replacement is None:
+                    continue
+                offset = locate(data, snap, i) if moved else snap["holes"][i][0]
+                if offset is None or offset in taken:
+                    conflicts.append(i)
+                else:
+                    taken.add(offset)
+                    edits.append((offset, offset + len(marker), replacement))
+            if edits:
+                write_atomic(snap["path"], sorted(edits), f)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+    return conflicts
+
+def replace_file(path, data):
+    write_atomic(path, [(0, float('inf'), data)])
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import contextlib
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+
+import Chat
+import Splice
+from Chat import chat, split_flags, number_flag
+from MockServer import MockServer
+
+# Benchmarks of Chat, holefill and chatsh against MockServer; no network.
+# Every metric is in seconds, lower is better.
+
+DEFAULT_OUTPUT = "bench.json"
+# A metric slower than the baseline by more than this fraction (and by more
+# than NOISE_FLOOR seconds) is a regression
+REGRESSION = 0.10
+NOISE_FLOOR = 0.0005
+MOCK_REPLY = "<COMPLETION>" + "token " * 50 + "</COMPLETION>"
+
+def usage():
+    print("Usage: bench.py [--runs=N] [--output=FILE] [--baseline=FILE] [--save-baseline=FILE]")
+    print("")
+    print("Measures startup time, client construction, ask() TTFT and latency, holefill's")
+    print("import expansion and splice, and chatsh's command capture, then writes the")
+    print(f"results as JSON (default: {DEFAULT_OUTPUT}), compared against a saved baseline.")
+    sys.exit(1)
+
+def summary(samples):
+    samples = sorted(samples)
+    return {
+        "p50": statistics.median(samples),
+        "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "mean": statistics.fmean(samples),
+    }
+
+def timed(fn, runs, setup=None):
+    samples = []
+    for _ in range(runs):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return summary(samples)
+
+async def timed_async(awaitable):
+    start = time.perf_counter()
+    await awaitable
+    return time.perf_counter() - start
+
+async def bench_clients(runs):
+    results = {"chat_construction": timed(lambda: chat("local"), runs)}
+    try:
+        from anthropic import AsyncAnthropic
+    except ImportError:
+        return results
+    os.environ.setdefault("ANTHROPIC_API_KEY", "mock")
+
+    def cold():
+        Chat.clients.clear()
+        Chat.get_client(AsyncAnthropic, "anthropic")
+
+    results["client_cold"] = timed(cold, runs)
+    results["client_pooled"] = timed(lambda: Chat.get_client(AsyncAnthropic, "anthropic"), runs)
+    await Chat.aclose_clients()
+    return results
+
+async def bench_ask(server, port, runs):
+    results = {}
+    models = {"local": "local"}
+    try:
+        import anthropic
+        os.environ["ANTHROPIC_BASE_URL"] = f"http://127.0.0.1:{port}"
+        os.environ.setdefault("ANTHROPIC_API_KEY", "mock")
+        models["anthropic"] = "claude-3-5-sonnet-latest"
+    except ImportError:
+        pass
+    Chat.LOCAL_URL = f"http://127.0.0.1:{port}"
+
+    for name, model in models.items():
+        ttft, latency = [], []
+        for _ in range(runs):
+            ask = chat(model)
+            await ask("ping", system="bench", on_text=lambda text: None)
+            last = (await ask(None))['last']
+            ttft.append(last["ttft"])
+            latency.append(last["latency"])
+        results[f"ask_{name}_ttft"] = summary(ttft)
+        results[f"ask_{name}_latency"] = summary(latency)
+
+        # Concurrent asks: throughput of the whole stack
+        start = time.perf_counter()
+        await asyncio.gather(*[chat(model)("ping", on_text=lambda text: None) for _ in range(runs)])
+        results[f"ask_{name}_concurrent_{runs}"] = summary([time.perf_counter() - start])
+    await Chat.aclose_clients()
+    return results
+
+def bench_holefill(runs):
+    import holefill
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        line = "function f(x) { return x * 2 + 1; } // filler filler filler\n"
+        for i in range(20):
+            (tmp / f"ctx{i}.js").write_text(line * 2000 + f"//./ctx{(i + 1) % 20}.js//\n")
+        main = "".join(f"//./ctx{i}.js//\n" + line * 500 for i in range(20))
+        main += "".join(line * 1000 + ".?.\n" for _ in range(50))
+        (tmp / "main.js").write_text(main)
+
+        def expand():
+            holefill.file_cache.clear()
+            holefill.expand_imports(tmp / "main.js", main)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            results["holefill_expand_imports_cold"] = timed(expand, runs)
+            results["holefill_expand_imports_cached"] = timed(lambda: holefill.expand_imports(tmp / "main.js", main), runs)
+        # Write-back of 50 completions into a 3 MB file, unchanged or edited
+        # since it was read
+        big = tmp / "big.js"
+        completions = [b"    return 42;"] * 50
+        snaps = []
+        setup = lambda: (big.write_text(main), snaps.append(Splice.snapshot(big, holefill.HOLE.encode())))
+        results["holefill_splice_50_holes"] = timed(lambda: Splice.splice_holes(snaps[-1], completions), runs, setup)
+
+        def edited():
+            setup()
+            with open(big, 'a') as f:
+                f.write("// edited\n")
+        results["holefill_splice_50_holes_rebased"] = timed(lambda: Splice.splice_holes(snaps[-1], completions),
+                                                            runs, edited)
+    return results
+
+async def bench_chatsh(runs):
+    sys.argv = sys.argv[:1]
+    import chatsh
+    results = {}
+    for name, command in [("chatsh_capture_1mb", "head -c 1000000 /dev/zero | tr '\\0' 'x' | fold -w 100"),
+                          ("chatsh_capture_50mb", "head -c 50000000 /dev/zero | tr '\\0' 'x' | fold -w 100")]:
+        samples = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            await chatsh.run_command(command, live=False)
+            samples.append(time.perf_counter() - start)
+        results[name] = summary(samples)
+        # The same command, drained without the capture, as a reference
+        samples = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            proc = await asyncio.create_subprocess_shell(command, stdout=asyncio.subprocess.DEVNULL)
+            await proc.wait()
+            samples.append(time.perf_counter() - start)
+        results[name + "_raw"] = summary(samples)
+    # Cost of a trivial command: a fresh shell each time, or the session's
+    shell = chatsh.Shell()
+    results["chatsh_command_fresh"] = summary([await timed_async(chatsh.run_command("true", live=False))
+                                               for _ in range(runs)])
+    results["chatsh_command_shell"] = summary([await timed_async(shell.run("true", live=False))
+                                               for _ in range(runs)])
+    shell.stop()
+    return results
+
+# Cold start of each tool: a fresh interpreter importing it
+def bench_startup(runs):
+    results = {}
+    for script in ("holefill", "chatsh"):
+        results[f"startup_{script}"] = timed(lambda: subprocess.run(
+            [sys.executable, "-c", f"import {script}"], check=True, cwd=Path(__file__).parent), runs)
+    return results
+
+def compare(results, baseline):
+    regressions = 0
+    print(f"{'metric':<40} {'baseline':>10} {'now':>10} {'change':>8}")
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        before, now = baseline[name]["p50"], stats["p50"]
+        change = (now - before) / before if before else 0.0
+        flag = " REGRESSION" if change > REGRESSION and now - before > NOISE_FLOOR else ""
+        regressions += bool(flag)
+        print(f"{name:<40} {before * 1000:>8.2f}ms {now * 1000:>8.2f}ms {change:>+7.1%}{flag}")
+    return regressions
+
+async def main():
+    args, flags = split_flags(sys.argv[1:])
+    if args or flags.get("help"):
+        usage()
+    try:
+        runs = number_flag(flags, "runs", 10)
+    except ValueError as e:
+        print(f"Error: {e}")
+        usage()
+
+    server = MockServer(MOCK_REPLY, ttft=0.02, latency=0.1)
+    port = await server.start(port=0)
+    results = {}
+    try:
+        results.update(bench_startup(runs))
+        results.update(await bench_clients(runs))
+        results.update(await bench_ask(server, port, runs))
+        results.update(bench_holefill(runs))
+        results.update(await bench_chatsh(runs))
+    finally:
+        await server.stop()
+
+    output = flags.get("output", DEFAULT_OUTPUT)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"results: {output}")
+
+    if flags.get("save-baseline"):
+        with open(flags["save-baseline"], 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if flags.get("baseline"):
+        with open(flags["baseline"], 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(results, baseline):
+            sys.exit(1)
+    else:
+        for name, stats in results.items():
+            print(f"{name:<40} p50 {stats['p50'] * 1000:>9.2f}ms  p95 {stats['p95'] * 1000:>9.2f}ms")
+
+if __name__ == "__main__":
+    asyncio.run(main())
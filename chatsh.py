@@ -1,23 +1,45 @@
 #!/usr/bin/env python3
 
-import readline
+import atexit
 import subprocess
 import asyncio
 import os
 import sys
-import datetime
 import re
+import signal
+import codecs
+import tempfile
+import time
+from collections import deque
 from pathlib import Path
 
 # Import chat function and models from Chat.py
-from Chat import chat, MODELS
+from Chat import MODELS, head_tail, TOOL_OUTPUT_MAX, split_flags, number_flag, echo, Trace, profile_startup
+from History import Log, CHATSH_LOG, search, get_entry, Session, find_session
+from Daemon import connect
 
 # Default model if not specified
 DEFAULT_MODEL = "c"
-# Get model from environment variable or use default 
-MODEL = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_MODEL
+ARGS, FLAGS = split_flags(sys.argv[1:])
+# Get model from environment variable or use default ("c,cm" races both)
+MODEL = ARGS[0] if ARGS else DEFAULT_MODEL
+
+# Limits on what a command feeds back to the model; the terminal sees it all
+OUTPUT_MAX_BYTES = 64 * 1024
+OUTPUT_MAX_LINES = 2000
+try:
+    # Seconds a command may run before it is killed (--timeout=N, 0 for none)
+    COMMAND_TIMEOUT = number_flag(FLAGS, 'timeout', float(os.environ.get('CHATSH_TIMEOUT', 0)), float) or None
+    # Run a reply's sh blocks concurrently, at most this many at once
+    # (--parallel[=N]); without it they run as one script
+    PARALLEL = 4 if FLAGS.get('parallel') is True else number_flag(FLAGS, 'parallel', 0)
+except ValueError as e:
+    print(f"Error: {e}")
+    sys.exit(1)
+# Run every command in a fresh shell instead of the session's shell
+# (--fresh-shell); cd and exports then do not carry over between turns
+FRESH_SHELL = bool(FLAGS.get('fresh-shell'))
 
-print(f"Welcome to ChatSH. Model: {MODELS.get(MODEL, MODEL)}\n")
 
 # System prompt to set the assistant's behavior
 SYSTEM_PROMPT = '''You are ChatSH, an AI language model that specializes in assisting users with tasks on their system using shell commands, AND chatting or answering open-ended questions via the terminal.
@@ -207,21 +229,282 @@ Done.
 
 - The system shell in use is: %s.'''%os.environ['SHELL']
 
-# Create history directory
-HISTORY_DIR = Path.home() / '.ai' / 'chatsh_history'
-HISTORY_DIR.mkdir(parents=True, exist_ok=True)
+if PARALLEL:
+    SYSTEM_PROMPT += """
 
-# Generate unique filename for conversation
-conversation_file = HISTORY_DIR / f"conversation_{datetime.datetime.now().isoformat().replace(':', '-')}.txt"
+- Separate ```sh blocks run concurrently, each in its own shell, and their outputs come back labelled per block. Put commands that depend on each other in the same block."""
 
-def append_to_history(role, message):
-    with open(conversation_file, 'a') as f:
-        f.write(f"<{role}>\n{message}\n</{role}>\n\n")
+# Conversation log, shared by all sessions
+history = Log(CHATSH_LOG)
+
+def append_to_history(role, message, **fields):
+    history.write(role=role, model=MODELS.get(MODEL, MODEL), text=message, **fields)
 
 def extract_codes(text):
     regex = r"```sh([\s\S]*?)```"
     matches = re.finditer(regex, text)
-    return [match.group(1).replace('$', '$$').strip() for match in matches]
+    return [match.group(1).strip() for match in matches]
+
+# Ring buffer over a command's output: keeps the last OUTPUT_MAX_LINES lines
+# within OUTPUT_MAX_BYTES, and counts what it had to drop.
+class OutputTail:
+    def __init__(self, max_bytes=OUTPUT_MAX_BYTES, max_lines=OUTPUT_MAX_LINES):
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self.lines = deque()
+        self.size = 0
+        self.dropped = 0
+        self.partial = b""
+
+    def write(self, data):
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self.lines.append(line)
+            self.size += len(line) + 1
+            while len(self.lines) > self.max_lines or self.size > self.max_bytes:
+                self.size -= len(self.lines.popleft()) + 1
+                self.dropped += 1
+        if len(self.partial) > self.max_bytes:
+            self.partial = self.partial[-self.max_bytes:]
+
+    def text(self):
+        body = b"\n".join(list(self.lines) + ([self.partial] if self.partial else []))
+        text = body.decode(errors="replace").strip()
+        if self.dropped:
+            text = f"[... {self.dropped} lines dropped ...]\n{text}"
+        return text
+
+async def pump(stream, tail, style):
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    while True:
+        data = await stream.read(65536)
+        if not data:
+            break
+        tail.write(data)
+        text = decoder.decode(data) if style is not None else None
+        if text:
+            sys.stdout.write(style + text + '\033[0m')
+            sys.stdout.flush()
+
+# Kill functions of the commands running now: a single SIGINT handler,
+# installed while any runs, kills them all
+running = set()
+previous_sigint = None
+
+def killpg(pgid):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+# Waits for `work`, a command's output being read, killing its process group
+# on Ctrl-C, on timeout or when cancelled; the partial output is still read.
+# Returns the result of `work` and why the command was killed, or None.
+async def supervise(pgid, work, timeout):
+    reasons = []
+    loop = asyncio.get_running_loop()
+
+    def kill(reason):
+        reasons.append(reason)
+        killpg(pgid)
+
+    global previous_sigint
+    if not running:
+        previous_sigint = signal.signal(signal.SIGINT, lambda *_: [loop.call_soon_threadsafe(k, "interrupted")
+                                                                    for k in list(running)])
+    running.add(kill)
+    work = asyncio.ensure_future(work)
+    try:
+        try:
+            result = await asyncio.wait_for(asyncio.shield(work), timeout)
+        except asyncio.TimeoutError:
+            kill(f"timed out after {timeout:g}s")
+            result = await work
+    except asyncio.CancelledError:
+        kill("cancelled")
+        work.cancel()
+        await asyncio.gather(work, return_exceptions=True)
+        raise
+    finally:
+        running.discard(kill)
+        if not running:
+            signal.signal(signal.SIGINT, previous_sigint)
+    return result, reasons[0] if reasons else None
+
+# What the model gets of a command: its stdout, its stderr, then notes such
+# as its exit status
+def command_output(stdout, stderr, notes):
+    output = stdout.text()
+    if stderr.text():
+        output += f"\n[stderr]\n{stderr.text()}"
+    for note in notes:
+        output += f"\n[{note}]"
+    return output.strip()
+
+# Runs a script, showing its output live while keeping a bounded tail of
+# stdout and stderr for the model. Ctrl-C or the timeout kill the whole
+# process group; the partial output is still returned.
+async def run_command(code, timeout=COMMAND_TIMEOUT, live=True):
+    proc = await asyncio.create_subprocess_shell(
+        code,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=True
+    )
+    stdout, stderr = OutputTail(), OutputTail()
+    start = time.perf_counter()
+    _, status = await supervise(proc.pid, asyncio.gather(pump(proc.stdout, stdout, '\033[2m' if live else None),
+                                                         pump(proc.stderr, stderr, '\033[2;31m' if live else None)),
+                                timeout)
+    await proc.wait()
+    if live:
+        print()
+    notes = [status] if status else [f"exit status {proc.returncode}"] if proc.returncode else []
+    return command_output(stdout, stderr, notes), proc.returncode, time.perf_counter() - start
+
+# Shells the session's worker can drive; any other $SHELL (fish, nu) gets sh
+WORKER_SHELLS = ('sh', 'bash', 'zsh', 'dash', 'ksh')
+
+# Reads a worker's stream up to the sentinel line that ends a command,
+# passing what comes before it to the tail (and the terminal). Returns the
+# rest of the sentinel line, or None if the stream ended first.
+async def pump_until(stream, tail, style, sentinel):
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    marker = b"\n" + sentinel
+
+    def emit(data):
+        tail.write(data)
+        text = decoder.decode(data) if style is not None else None
+        if text:
+            sys.stdout.write(style + text + '\033[0m')
+            sys.stdout.flush()
+
+    pending = b""
+    while True:
+        data = await stream.read(65536)
+        if not data:
+            emit(pending)
+            return None
+        pending += data
+        found = pending.find(marker)
+        if found != -1:
+            end = pending.find(b"\n", found + len(marker))
+            if end != -1:
+                emit(pending[:found])
+                return pending[found + len(marker):end].decode(errors="replace")
+            continue
+        # Hold back what could be the start of the sentinel
+        emit(pending[:-len(marker)])
+        pending = pending[-len(marker):]
+
+# The session's shell: one long-lived process runs every command, so cd,
+# exports and activated virtualenvs carry over between turns and no shell
+# starts per command. A command is sourced from a script file with stdin
+# from /dev/null; a sentinel line carrying its exit status and the working
+# directory then marks its end on stdout, and a bare one on stderr. A
+# command that times out, is interrupted or exits takes the worker down
+# with it; the next command starts a new one in the last working directory.
+class Shell:
+    def __init__(self):
+        executable = os.environ.get('SHELL') or '/bin/sh'
+        self.executable = executable if os.path.basename(executable) in WORKER_SHELLS else '/bin/sh'
+        self.proc = None
+        self.cwd = os.getcwd()
+        token = os.urandom(8).hex()
+        self.sentinel = f"__chatsh_{token}__".encode()
+        self.script = Path(tempfile.gettempdir()) / f"chatsh-{os.getpid()}-{token}.sh"
+        self.started = 0
+
+    async def start(self):
+        self.proc = await asyncio.create_subprocess_exec(
+            self.executable,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=self.cwd if os.path.isdir(self.cwd) else None,
+            start_new_session=True
+        )
+        self.started += 1
+
+    def stop(self):
+        if self.proc and self.proc.returncode is None:
+            killpg(self.proc.pid)
+        self.proc = None
+        self.script.unlink(missing_ok=True)
+
+    # Runs `code` like run_command does, in the session's shell
+    async def run(self, code, timeout=COMMAND_TIMEOUT, live=True):
+        notes = []
+        if self.proc is None or self.proc.returncode is not None:
+            if self.started:
+                notes.append(f"shell restarted in {self.cwd}; variables and functions were reset")
+            await self.start()
+        proc = self.proc
+        self.script.write_text(code + "\n", encoding='utf-8')
+        sentinel = self.sentinel.decode()
+        proc.stdin.write((f". '{self.script}' < /dev/null\n"
+                          f"printf '\\n{sentinel} %d %s\\n' \"$?\" \"$PWD\"\n"
+                          f"printf '\\n{sentinel}\\n' >&2\n").encode())
+        stdout, stderr = OutputTail(), OutputTail()
+
+        async def read():
+            try:
+                await proc.stdin.drain()
+            except ConnectionError:
+                # Died since the last command; the pumps see it end
+                pass
+            end, _ = await asyncio.gather(pump_until(proc.stdout, stdout, '\033[2m' if live else None, self.sentinel),
+                                          pump_until(proc.stderr, stderr, '\033[2;31m' if live else None, self.sentinel))
+            return end
+
+        start = time.perf_counter()
+        end, status = await supervise(proc.pid, read(), timeout)
+        if live:
+            print()
+
+        if end is None:
+            # The shell is gone: killed here, or the command exited it
+            killpg(proc.pid)
+            await proc.wait()
+            returncode = proc.returncode
+            status = status or "shell exited"
+            notes.append(status if returncode < 0 else f"{status}, exit status {returncode}")
+        else:
+            returncode, _, cwd = end[1:].partition(" ")
+            returncode = int(returncode)
+            self.cwd = cwd or self.cwd
+            if returncode:
+                notes.append(f"exit status {returncode}")
+        return command_output(stdout, stderr, notes), returncode, time.perf_counter() - start
+
+# Runs independent sh blocks in a pool of `limit` processes. Each block's
+# output is shown when it finishes and is sent to the model under its own
+# header, with its exit status and duration.
+async def run_blocks(codes, limit=PARALLEL):
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(i, code):
+        async with semaphore:
+            output, status, duration = await run_command(code, live=False)
+        header = f"[block {i + 1}: exit {status}, {duration:.2f}s] $ {code.splitlines()[0] if code else ''}"
+        print(f"\033[1m{header}\033[0m")
+        if output:
+            print('\033[2m' + output + '\033[0m')
+        return header, output, status
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[run(i, code) for i, code in enumerate(codes)])
+    # The headers and separators are kept whole; the outputs share the rest
+    # of the budget, shorter ones first, so the whole fits TOOL_OUTPUT_MAX
+    budget = TOOL_OUTPUT_MAX - sum(len(header) + 1 for header, _, _ in results) - 2 * (len(results) - 1)
+    shares = {}
+    for left, i in enumerate(sorted(range(len(results)), key=lambda i: len(results[i][1])), 1):
+        shares[i] = min(len(results[i][1]), max(budget, 0) // (len(results) - left + 1))
+        budget -= shares[i]
+    output = "\n\n".join(f"{header}\n{head_tail(output, shares[i])}" for i, (header, output, _) in enumerate(results))
+    return output, [status for _, _, status in results], time.perf_counter() - start
 
 async def get_shell():
     proc = await asyncio.create_subprocess_shell(
@@ -232,15 +515,91 @@ async def get_shell():
     stdout, _ = await proc.communicate()
     return stdout.decode().strip()
 
+async def send(ask, full_message, on_text=echo):
+    # Handle different model types
+    if MODEL in ["o", "om"]:
+        return await ask(full_message, system=None, model=MODEL, max_tokens=8192, system_cacheable=True, history_cacheable=True, on_text=on_text)
+    else:
+        return await ask(full_message, system=SYSTEM_PROMPT, model=MODEL, max_tokens=8192, system_cacheable=True, history_cacheable=True, on_text=on_text)
+
+# Speculative request for the default next turn (sending the command output
+# with no new message), started while the user is still reading the output.
+# Its text is held back until the user accepts it by pressing enter; any
+# other input cancels it and restores the conversation.
+class Prefetch:
+    def __init__(self, ask, messages, full_message):
+        self.messages = messages
+        self.saved = list(messages)
+        self.chunks = []
+        self.live = False
+        self.task = asyncio.create_task(send(ask, full_message, self.on_text))
+
+    def on_text(self, text):
+        if self.live:
+            echo(text)
+        else:
+            self.chunks.append(text)
+
+    async def accept(self):
+        self.live = True
+        echo(''.join(self.chunks))
+        return await self.task
+
+    async def discard(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except BaseException:
+            pass
+        self.messages[:] = self.saved
+
 async def main():
+    global MODEL
+    if FLAGS.get('profile-startup'):
+        return profile_startup('chatsh')
+    # Line editing for input(); only the interactive loop needs it
+    import readline
     last_output = ""
-    ask = chat(MODEL)
+    # The conversation is saved after every turn, so it can be resumed
+    session = Session(history.session)
+    # --resume[=ID] picks up the latest session (or session ID) where it
+    # stopped: conversation, last command output, model and directory
+    if FLAGS.get('resume'):
+        session = find_session(None if FLAGS['resume'] is True else FLAGS['resume'])
+        if session is None:
+            print("No session to resume.")
+            sys.exit(1)
+        # A model given on the command line takes over, at the cost of the
+        # prompt cache
+        MODEL = ARGS[0] if ARGS else session.model or MODEL
+        last_output = session.output
+        if session.cwd and os.path.isdir(session.cwd):
+            os.chdir(session.cwd)
+    print(f"Welcome to ChatSH. Model: {MODELS.get(MODEL, MODEL)}\n")
+    # Requests go through the daemon (Daemon.py) if one runs
+    ask = connect(MODEL)
+    if session.messages:
+        # The same messages in the same order, so the provider's prompt cache
+        # still matches them
+        (await ask(None))['messages'][:] = session.messages
+        print(f"\033[2m[resumed session {session.id}: {len(session.messages)} messages]\033[0m")
+    # Commands run in one shell for the whole session
+    shell = Shell()
+    atexit.register(shell.stop)
+    if FLAGS.get('trace'):
+        # --trace prints a summary of every call on exit; --trace=FILE also
+        # appends the calls' spans to FILE
+        trace = Trace()
+        trace.attach(ask)
+        atexit.register(trace.report, FLAGS['trace'])
 
     if MODEL in ["o", "om"]:
         print("NOTE: disabling system prompt.")
 
     # Get initial message from command line args if provided
-    initial_message = ' '.join(sys.argv[2:]) if len(sys.argv) > 2 else None
+    initial_message = ' '.join(ARGS[1:]) if len(ARGS) > 1 else None
+
+    prefetch = None
 
     while True:
         try:
@@ -249,24 +608,58 @@ async def main():
                 initial_message = None
             else:
                 print('\033[1m', end='')  # bold
-                user_message = input('λ ')
+                # Read in a thread while a prefetch runs, so it can progress
+                user_message = await asyncio.to_thread(input, 'λ ') if prefetch else input('λ ')
                 print('\033[0m', end='')  # reset
 
-            full_message = f"<SYSTEM>\n{last_output.strip()}\n</SYSTEM>\n<USER>\n{user_message}\n</USER>\n" if user_message.strip() else f"<SYSTEM>\n{last_output.strip()}\n</SYSTEM>"
+            if prefetch and user_message.strip() and not user_message.startswith('/search '):
+                await prefetch.discard()
+                prefetch = None
+
+            # Search past sessions, or replay an answer found that way
+            if user_message.startswith('/search '):
+                for row in search(user_message[len('/search '):], limit=10):
+                    snippet = (row['reply'] or row['prompt'] or '').strip().replace('\n', ' ')[:80]
+                    print(f"\033[2m{row['id']:>6} {row['ts'][:16]} {row['tool']:<8} {snippet}\033[0m")
+                continue
+            reused = None
+            if user_message.startswith('/reuse '):
+                reused = get_entry(int(user_message.split()[1]))
+                if not reused or not reused['reply']:
+                    print("Nothing to reuse.")
+                    continue
+                user_message = reused['prompt'] or user_message
+
+            last_output = head_tail(last_output.strip())
+            full_message = f"<SYSTEM>\n{last_output}\n</SYSTEM>\n<USER>\n{user_message}\n</USER>\n" if user_message.strip() else f"<SYSTEM>\n{last_output}\n</SYSTEM>"
 
             append_to_history('USER', user_message)
 
-            # Handle different model types
-            if MODEL in ["o", "om"]:
-                assistant_message = await ask(full_message, {"system": None, "model": MODEL, "max_tokens": 8192, "system_cacheable": True})
+            if reused:
+                assistant_message = reused['reply']
+                print(assistant_message)
+                (await ask(None))['messages'].extend([
+                    {"role": "user", "content": full_message},
+                    {"role": "assistant", "content": assistant_message}
+                ])
+                append_to_history('ChatSH', assistant_message, prompt=user_message, reused=reused['id'])
             else:
-                assistant_message = await ask(full_message, {"system": SYSTEM_PROMPT, "model": MODEL, "max_tokens": 8192, "system_cacheable": True})
+                if prefetch:
+                    assistant_message = await prefetch.accept()
+                    prefetch = None
+                else:
+                    assistant_message = await send(ask, full_message)
 
-            print()
-            append_to_history('ChatSH', assistant_message)
+                print()
+                last = (await ask(None))['last']
+                compacted = f", compacted: -{last['saved_tokens']} tokens" if last.get('saved_tokens') else ""
+                print(f"\033[2m[cache read: {last.get('cache_read', 0)}, cache write: {last.get('cache_write', 0)}{compacted}, {last.get('latency', 0):.2f}s]\033[0m")
+                append_to_history('ChatSH', assistant_message, prompt=user_message, usage=last.get('usage'),
+                                  latency=last.get('latency'), ttft=last.get('ttft'))
 
             codes = extract_codes(assistant_message)
             last_output = ""
+            ran = False
 
             if codes:
                 combined_code = '\n'.join(codes)
@@ -281,23 +674,30 @@ async def main():
                     last_output = "Command skipped.\n"
                 else:
                     try:
-                        proc = await asyncio.create_subprocess_shell(
-                            combined_code,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE
-                        )
-                        stdout, stderr = await proc.communicate()
-                        output = f"{stdout.decode().strip()}{stderr.decode().strip()}"
-                        print('\033[2m' + output.strip() + '\033[0m')
+                        if PARALLEL and len(codes) > 1:
+                            output, status, duration = await run_blocks(codes)
+                        else:
+                            output, status, duration = await (run_command(combined_code) if FRESH_SHELL
+                                                              else shell.run(combined_code))
                         last_output = output
-                        append_to_history('SYSTEM', output)
+                        append_to_history('SYSTEM', output, status=status, latency=duration)
+                        ran = True
                     except Exception as e:
                         output = str(e)
                         print('\033[2m' + output.strip() + '\033[0m')
                         last_output = output
                         append_to_history('SYSTEM', output)
 
+            # Saved before a prefetch adds to the conversation
+            session.save((await ask(None))['messages'], last_output, MODEL, shell.cwd)
+            # A turn is searchable from other sessions once it is done
+            history.flush()
+            if ran and FLAGS.get('prefetch'):
+                prefetch = Prefetch(ask, (await ask(None))['messages'],
+                                    f"<SYSTEM>\n{head_tail(last_output.strip())}\n</SYSTEM>")
+
         except Exception as e:
+            prefetch = None
             print(f"Error: {str(e)}")
             append_to_history('ERROR', str(e))
 
@@ -2,103 +2,678 @@
 import os
 import sys
 import re
+import asyncio
+import time
+import json
+import hashlib
+import mmap
+import math
 from pathlib import Path
-from datetime import datetime
-from typing import Optional
+from collections import Counter, OrderedDict
 
 # Assuming Chat.py exists with these functions
-from Chat import chat, MODELS, token_count
+from Chat import (chat, MODELS, token_count, aclose_clients, split_flags, number_flag, echo, Trace,
+                  profile_startup, supports_prediction)
+from History import Log, HOLEFILL_LOG, find_reply
+from Daemon import run_remote
+from Splice import snapshot, changed, splice_holes, replace_file
 
 SYSTEM = "You're a code completion assistant."
+HOLE = ".?."
 FILL = "{:FILL_HERE:}"
 TASK = f"### TASK: complete the {FILL} part of the file above. Write ONLY the needed text to replace {FILL} by the correct completion, including correct spacing and indentation. Include the answer inside a <COMPLETION></COMPLETION> tag."
+TEMPERATURE = 0.0
+DEFAULT_JOBS = 8
+CACHE_DIR = Path.home() / '.ai' / 'holefill_cache'
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+CACHE_MAX_ENTRIES = 4096
 
-async def main():
-    if len(sys.argv) < 2:
-        print("Usage: holefill <file> [<shortened_file>] [<model_name>]")
-        print("")
-        print("This will complete a HOLE, written as '.?.', in <file>, using the AI.")
-        print("A shortened file can be used to omit irrelevant parts.")
-        sys.exit(1)
+def usage():
+    print("Usage: holefill <file> [<shortened_file>] [<model_name>]")
+    print("       holefill --batch [--model=<model_name>] [--jobs=N] <file>...")
+    print("Options: --no-cache  always ask the model, ignoring cached completions")
+    print("         --reuse     reuse the answer to an identical prompt from the history")
+    print("         --budget=N  send only the most relevant context around each hole,")
+    print("                     from the file, its imports and its sibling files, in N tokens")
+    print("         --profile-startup  report import time, and what each model SDK adds")
+    print("         --edit[=INSTRUCTION]  have the model reply with the change to the file (by")
+    print("                     default: filling its holes) instead of one completion per hole")
+    print("         --trace[=F] print timing and usage per model; with F, append every call's span to F")
+    print("")
+    print("This will complete every HOLE, written as '.?.', in <file>, using the AI.")
+    print("A shortened file can be used to omit irrelevant parts.")
+    print("Several models, as in 'C,cm,g', race: the first answer wins.")
+    print("In batch mode, holes across all files are completed concurrently,")
+    print("with at most N requests in flight (default: %d)." % DEFAULT_JOBS)
+    print("Requests per model are also capped by $AI_CONCURRENCY and $AI_TPM (tokens")
+    print("per minute); rate-limited requests are retried after the server's retry-after.")
+    sys.exit(1)
 
-    file = sys.argv[1]
-    mini = sys.argv[2] if len(sys.argv) > 2 else None
-    model = sys.argv[3] if len(sys.argv) > 3 else "C"
-    ask = chat(model)
+# Context files are imported with //./path//, relative to the importing file.
+# Imports nest; a file is included once, and imports back into a file that
+# is still being expanded are dropped.
+IMPORT = re.compile(r"//\./(.*?)//")
+MMAP_THRESHOLD = 1024 * 1024
+# Texts of files read, least recently used first; the daemon keeps it for
+# its whole life, so it is bounded
+FILE_CACHE_MAX_CHARS = 64 * 1024 * 1024
+FILE_CACHE_MAX_ENTRIES = 1024
+file_cache = OrderedDict()
+
+def read_cached(path):
+    stat = os.stat(path)
+    cached = file_cache.get(path)
+    if cached and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        file_cache.move_to_end(path)
+        return cached[1]
+    if stat.st_size >= MMAP_THRESHOLD:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            text = str(data, 'utf-8')
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+    file_cache[path] = ((stat.st_mtime_ns, stat.st_size), text)
+    file_cache.move_to_end(path)
+    size = sum(len(cached[1]) for cached in file_cache.values())
+    while len(file_cache) > 1 and (size > FILE_CACHE_MAX_CHARS or len(file_cache) > FILE_CACHE_MAX_ENTRIES):
+        size -= len(file_cache.popitem(last=False)[1][1])
+    return text
+
+# `holes`, if given, gets the offsets in the result of the holes of `code`
+# itself: those of imported files are context, not holes to fill. `files`,
+# if given, gets the (path, text) of every imported file.
+def expand_imports(file, code, holes=None, files=None):
+    out = []
+    resolve_imports(Path(file).parent, code, out, set(), [Path(file).resolve()], holes, files)
+    return ''.join(out)
+
+def resolve_imports(base, code, out, seen, stack, holes=None, files=None):
+    def own(text):
+        if holes is not None:
+            offset = sum(len(piece) for piece in out)
+            holes.extend(offset + hole for hole in find_holes(text))
+        out.append(text)
+
+    pos = 0
+    for match in IMPORT.finditer(code):
+        own(code[pos:match.start()])
+        pos = match.end()
+        import_path = (base / match.group(1)).resolve()
+        if import_path in stack:
+            print("import_file:", match.group(0), "CYCLE")
+            continue
+        if import_path in seen:
+            print("import_file:", match.group(0), "DUPLICATE")
+            continue
+        if not import_path.is_file():
+            raise FileNotFoundError(match.group(0))
+        seen.add(import_path)
+        print("import_file:", match.group(0))
+        out.append('\n')
+        stack.append(import_path)
+        text = read_cached(import_path)
+        if files is not None:
+            files.append((import_path, text))
+        resolve_imports(import_path.parent, text, out, seen, stack, None, files)
+        stack.pop()
+    own(code[pos:])
+
+def find_holes(code):
+    holes = []
+    pos = code.find(HOLE)
+    while pos != -1:
+        holes.append(pos)
+        pos = code.find(HOLE, pos + len(HOLE))
+    return holes
+
+def fill_source(code, hole):
+    return code[:hole] + FILL + code[hole + len(HOLE):]
+
+def hole_prompts(code, holes=None):
+    # One prompt per hole: the hole being asked for becomes FILL, the
+    # others stay visible as holes.
+    return [fill_source(code, hole) + "\n\n" + TASK for hole in (find_holes(code) if holes is None else holes)]
+
+# Automatic context (--budget=N): instead of the whole file and its imports,
+# the prompt gets the code around the hole plus the chunks of the file, its
+# imports and its sibling files that rank best (BM25) against the
+# identifiers near the hole, packed into N tokens.
+WINDOW_LINES = 40
+CHUNK_LINES = 20
+PROJECT_MAX_FILES = 200
+BM25_K1 = 1.2
+BM25_B = 0.75
+IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+def terms(text):
+    return [term.lower() for term in IDENTIFIER.findall(text)]
+
+def split_chunks(text):
+    # Chunks of about CHUNK_LINES lines, cut at blank lines where possible
+    chunks, start, lines = [], 0, 0
+    for match in re.finditer(r"\n", text):
+        lines += 1
+        end = match.end()
+        blank = text.startswith("\n", end) or end == len(text)
+        if lines >= 2 * CHUNK_LINES or (lines >= CHUNK_LINES and blank):
+            chunks.append((start, end))
+            start, lines = end, 0
+    if start < len(text):
+        chunks.append((start, len(text)))
+    return chunks
+
+def bm25(query, docs):
+    query = set(query)
+    counts = [Counter(doc) for doc in docs]
+    avg_len = sum(len(doc) for doc in docs) / max(len(docs), 1) or 1
+    df = Counter(term for c in counts for term in query if term in c)
+    scores = []
+    for doc, c in zip(docs, counts):
+        score = 0.0
+        for term in query:
+            tf = c.get(term)
+            if tf:
+                idf = math.log(1 + (len(docs) - df[term] + 0.5) / (df[term] + 0.5))
+                score += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * len(doc) / avg_len))
+        scores.append(score)
+    return scores
+
+def project_chunks(file):
+    path = Path(file).resolve()
+    chunks = []
+    siblings = sorted(p for p in path.parent.iterdir() if p.suffix == path.suffix and p != path and p.is_file())
+    for sibling in siblings[:PROJECT_MAX_FILES]:
+        try:
+            text = read_cached(sibling)
+        except (UnicodeDecodeError, OSError):
+            continue
+        chunks += [(sibling.name, text[start:end]) for start, end in split_chunks(text)]
+    return chunks
+
+# The hole's line and `lines` lines on each side of it
+def hole_window(source, hole, lines):
+    window_start = hole
+    for _ in range(lines + 1):
+        window_start = source.rfind("\n", 0, max(window_start - 1, 0)) + 1
+        if window_start == 0:
+            break
+    window_end = hole
+    for _ in range(lines + 1):
+        window_end = source.find("\n", window_end + 1)
+        if window_end == -1:
+            window_end = len(source)
+            break
+    return window_start, window_end
+
+# `reserved` tokens of the budget go to the rest of the prompt
+def select_context(source, extra, budget, model, reserved=0):
+    # `source` holds FILL; the window around it is always kept, narrowed
+    # until it fits the budget
+    hole = source.index(FILL)
+    lines = WINDOW_LINES
+    while True:
+        window_start, window_end = hole_window(source, hole, lines)
+        window = source[window_start:window_end]
+        used = reserved + token_count(assemble(source, window_start, window, []), model)
+        if used <= budget:
+            break
+        if lines == 0:
+            raise ValueError(f"the line of the hole alone makes a {used}-token prompt, over the budget of {budget}")
+        lines //= 2
+
+    candidates = [("", source[start:end], start) for start, end in split_chunks(source[:window_start])]
+    candidates += [("", source[window_end + start:window_end + end], window_end + start)
+                   for start, end in split_chunks(source[window_end:])]
+    candidates += [(name, text, i) for i, (name, text) in enumerate(extra)]
+    scores = bm25(terms(window), [terms(text) for _, text, _ in candidates])
+
+    picked = []
+    for score, candidate in sorted(zip(scores, candidates), key=lambda sc: -sc[0]):
+        cost = token_count(candidate[1], model)
+        if score > 0 and used + cost <= budget:
+            picked.append(candidate)
+            used += cost
+    # The headers and gap markers count too: drop the lowest ranked chunks
+    # until they fit
+    context = assemble(source, window_start, window, picked)
+    while picked and reserved + token_count(context, model) > budget:
+        picked.pop()
+        context = assemble(source, window_start, window, picked)
+    return context
+
+# Other files first, then the file itself in its own order with the gaps marked
+def assemble(source, window_start, window, picked):
+    out = []
+    for name in dict.fromkeys(name for name, _, _ in sorted(picked, key=lambda c: c[2]) if name):
+        out.append(f"### {name}:\n")
+        out += [text for n, text, _ in sorted(picked, key=lambda c: c[2]) if n == name]
+        out.append("\n")
+    own = sorted([(offset, text) for name, text, offset in picked if not name] + [(window_start, window)])
+    pos = 0
+    for offset, text in own:
+        if offset > pos:
+            out.append("...\n")
+        out.append(text)
+        pos = offset + len(text)
+    if pos < len(source):
+        out.append("\n...\n")
+    return ''.join(out)
 
+# --budget counts the whole prompt, the task included
+def auto_prompts(file, code, holes, budget, model):
+    extra = project_chunks(file)
+    reserved = token_count("\n\n" + TASK, model)
+    return [select_context(fill_source(code, hole), extra, budget, model, reserved) + "\n\n" + TASK
+            for hole in holes]
+
+def prepare(file, mini, model, budget=None):
+    # Taken before reading: a change after it is seen when writing back
+    snap = snapshot(file, HOLE.encode('utf-8'))
     with open(file, 'r', encoding='utf-8') as f:
         file_code = f.read()
-    
+
     mini_code = file_code
     if mini:
         with open(mini, 'r', encoding='utf-8') as f:
             mini_code = f.read()
 
-    # Import context files
-    regex = r"//\./(.*?)//"
-    for match in re.finditer(regex, mini_code):
-        import_path = Path(file).parent / match.group(1)
-        if import_path.exists():
-            with open(import_path, 'r', encoding='utf-8') as f:
-                import_text = f.read()
-            print("import_file:", match.group(0))
-            mini_code = mini_code.replace(match.group(0), '\n' + import_text)
-        else:
-            print("import_file:", match.group(0), "ERROR")
-            sys.exit(1)
+    own_holes = []
+    try:
+        mini_code = expand_imports(file, mini_code, own_holes)
+    except FileNotFoundError as e:
+        print("import_file:", e.args[0], "ERROR")
+        sys.exit(1)
 
     if mini:
         with open(mini, 'w', encoding='utf-8') as f:
             f.write(mini_code)
 
-    tokens = token_count(mini_code)
-    source = mini_code.replace(".?.", FILL)
-    prompt = source + "\n\n" + TASK
-    predict = "<COMPLETION>\n" + source + "</COMPLETION>"
+    print("token_count:", token_count(mini_code, model))
 
-    ai_dir = Path.home() / '.ai'
-    ai_dir.mkdir(exist_ok=True)
-    
-    with open(ai_dir / '.holefill', 'w', encoding='utf-8') as f:
-        f.write(f"{SYSTEM}\n###\n{prompt}")
+    if budget:
+        try:
+            prompts = auto_prompts(file, mini_code, own_holes, budget, model)
+        except ValueError as e:
+            print(f"Error: {file}: {e}")
+            sys.exit(1)
+        print("context_tokens:", ', '.join(str(token_count(prompt, model)) for prompt in prompts))
+    else:
+        prompts = hole_prompts(mini_code, own_holes)
+    # Completions are written by index into the file's holes
+    holes = len(snap["holes"])
+    if len(prompts) != holes:
+        print(f"Error: {mini or file} has {len(prompts)} holes, but {file} has {holes}.")
+        sys.exit(1)
 
-    print("token_count:", tokens)
-    print("model_label:", MODELS.get(model, model))
+    return {"file": file, "code": file_code, "prompts": prompts, "snapshot": snap}
 
-    if ".?." not in mini_code:
-        print("No hole found.")
-        sys.exit(1)
+# Completions are cached on disk, addressed by everything that determines the
+# reply. An entry's mtime is its last use, which drives LRU eviction.
+def cache_key(prompt, model):
+    key = json.dumps([SYSTEM, prompt, MODELS.get(model, model), TEMPERATURE])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+def cache_get(key):
+    path = CACHE_DIR / f"{key}.txt"
+    try:
+        reply = path.read_text(encoding='utf-8')
+    except FileNotFoundError:
+        return None
+    os.utime(path)
+    return reply
+
+def cache_put(key, reply):
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = CACHE_DIR / f"{key}.{os.getpid()}.tmp"
+    tmp_path.write_text(reply, encoding='utf-8')
+    os.replace(tmp_path, CACHE_DIR / f"{key}.txt")
+
+def cache_evict():
+    if not CACHE_DIR.exists():
+        return
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith('.txt'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort(reverse=True)
+    total = 0
+    for i, (_, size, path) in enumerate(entries):
+        total += size
+        if total > CACHE_MAX_BYTES or i >= CACHE_MAX_ENTRIES:
+            os.remove(path)
+
+async def complete(prompt, model, on_text, use_cache=True, file=None, reuse=False, trace=None):
+    key = cache_key(prompt, model)
+    reply = cache_get(key) if use_cache else None
+    if reply is None and reuse:
+        reply = find_reply(prompt, model=MODELS.get(model, model), tool='holefill')
+    if reply is not None:
+        on_text(reply)
+        return extract_completion(reply), {"ttft": 0.0, "latency": 0.0, "cached": True}
+
+    ask = chat(model)
+    if trace:
+        trace.attach(ask)
+    reply = await ask(prompt, system=SYSTEM, model=model, temperature=TEMPERATURE,
+                      max_tokens=8192, on_text=on_text)
 
-    reply = await ask(prompt, system=SYSTEM, model=model, max_tokens=8192)
-    
     if "<COMPLETION>" not in reply:
         reply = "<COMPLETION>" + reply
     if "</COMPLETION>" not in reply:
         reply = reply + "</COMPLETION>"
 
+    last = (await ask(None))['last']
+    save_prompt_history(SYSTEM, prompt, reply, MODELS.get(model, model), file=file, temperature=TEMPERATURE,
+                        usage=last.get('usage'), latency=last.get('latency'), ttft=last.get('ttft'))
+
+    completion = extract_completion(reply)
+    cache_put(key, reply)
+    return completion, last
+
+def extract_completion(reply):
     match = re.search(r"<COMPLETION>([\s\S]*?)</COMPLETION>", reply)
-    if match:
-        file_code = file_code.replace(".?.", match.group(1))
+    if not match:
+        raise ValueError("Could not find <COMPLETION> tags in the AI's response.")
+    return match.group(1)
+
+async def fill(jobs, model, limit, use_cache=True, reuse=False, trace=None):
+    holes = [(job, i) for job in jobs for i in range(len(job["prompts"]))]
+    # A single hole streams to the terminal; concurrent ones would interleave.
+    stream = len(holes) == 1
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(job, i):
+        async with semaphore:
+            completion, last = await complete(job["prompts"][i], model, echo if stream else (lambda text: None),
+                                              use_cache, file=os.path.abspath(job["file"]), reuse=reuse, trace=trace)
+            if stream:
+                print()
+            if last.get("cached"):
+                print(f"hole {job['file']}#{i + 1}: cached")
+            else:
+                print(f"hole {job['file']}#{i + 1}: ttft {last['ttft']:.3f}s, done in {last['latency']:.2f}s")
+            return completion
+
+    start = time.perf_counter()
+    try:
+        results = await asyncio.gather(*[run(job, i) for job, i in holes], return_exceptions=True)
+    finally:
+        cache_evict()
+
+    failed = 0
+    for job in jobs:
+        completions = []
+        for (owner, i), result in zip(holes, results):
+            if owner is not job:
+                continue
+            if isinstance(result, BaseException):
+                print(f"Error: hole {job['file']}#{i + 1}: {result}")
+                completions.append(None)
+                failed += 1
+            else:
+                completions.append(result)
+        # Holes are written in place, found again by their surroundings if
+        # the file was edited meanwhile
+        replacements = [None if c is None else c.encode('utf-8') for c in completions]
+        if any(r is not None for r in replacements):
+            for i in splice_holes(job["snapshot"], replacements):
+                print(f"Error: hole {job['file']}#{i + 1}: the file changed around it, not written")
+                failed += 1
+
+    print(f"filled: {len(holes) - failed}/{len(holes)} holes in {time.perf_counter() - start:.2f}s")
+    return failed
+
+# Edit mode (--edit[=INSTRUCTION]): instead of one completion per hole, the
+# model answers with the change itself, so that output tokens (and latency)
+# grow with the size of the change rather than the size of the file. Models
+# that take a predicted output rewrite the whole file, with the original as
+# the prediction; the others reply with SEARCH/REPLACE blocks. Either way,
+# the result is checked here and a rejected reply is sent back once.
+EDIT_INSTRUCTION = f"Replace every {HOLE} hole by the code it stands for, adjusting the code around it where needed."
+EDIT_TASK = """### TASK: {instruction}
+Reply ONLY with SEARCH/REPLACE blocks, in this format:
+<<<<<<< SEARCH
+exact lines of the file above, with their indentation
+=======
+the lines that replace them
+>>>>>>> REPLACE
+Keep every SEARCH as short as possible while matching exactly one place in the file."""
+REWRITE_TASK = """### TASK: {instruction}
+Reply with the whole updated file inside a <COMPLETION></COMPLETION> tag, leaving everything else unchanged."""
+EDIT_BLOCK = re.compile(r"<<<<<<< SEARCH\n([\s\S]*?)\n?=======\n([\s\S]*?)\n?>>>>>>> REPLACE")
+EDIT_ATTEMPTS = 2
+
+def apply_edits(code, reply):
+    blocks = EDIT_BLOCK.findall(reply)
+    if not blocks:
+        raise ValueError("no SEARCH/REPLACE block found")
+    spans = []
+    for i, (search, replace) in enumerate(blocks):
+        count = code.count(search) if search else 0
+        if count != 1:
+            raise ValueError(f"the SEARCH text of block {i + 1} matches {count} places instead of one")
+        start = code.index(search)
+        end = start + len(search)
+        # Deleted lines take their line break with them
+        if not replace and code[end:end + 1] == "\n":
+            end += 1
+        spans.append((start, end, replace))
+    spans.sort()
+    for (_, end, _), (start, _, _) in zip(spans, spans[1:]):
+        if start < end:
+            raise ValueError("two blocks change the same lines")
+    out, pos = [], 0
+    for start, end, replace in spans:
+        out += [code[pos:start], replace]
+        pos = end
+    out.append(code[pos:])
+    return ''.join(out)
+
+def apply_rewrite(code, reply):
+    edited = extract_completion(reply)
+    if edited.startswith("\n") and not code.startswith("\n"):
+        edited = edited[1:]
+    if not edited.strip():
+        raise ValueError("the rewritten file is empty")
+    return edited
+
+async def edit(job, model, instruction, on_text, trace=None):
+    code = job["code"]
+    # A shortened file cannot be rewritten whole; its SEARCH blocks still
+    # apply to the full file
+    rewrite = supports_prediction(model) and job["source"] == code
+    task = REWRITE_TASK if rewrite else EDIT_TASK
+    prompt = job["source"] + "\n\n" + task.format(instruction=instruction)
+    predict = f"<COMPLETION>\n{code}</COMPLETION>" if rewrite else None
+
+    ask = chat(model)
+    if trace:
+        trace.attach(ask)
+    message = prompt
+    for attempt in range(EDIT_ATTEMPTS):
+        reply = await ask(message, system=SYSTEM, model=model, temperature=TEMPERATURE,
+                          max_tokens=16384 if rewrite else 8192, on_text=on_text, predict=predict)
+        last = (await ask(None))['last']
+        save_prompt_history(SYSTEM, message, reply, MODELS.get(model, model), file=os.path.abspath(job["file"]),
+                            mode="rewrite" if rewrite else "edit", usage=last.get('usage'),
+                            latency=last.get('latency'), ttft=last.get('ttft'))
+        # Applies the reply to the file as it is when written back
+        def apply(current):
+            if rewrite and current != code:
+                raise ValueError("the file changed while the model was rewriting it")
+            edited = apply_rewrite(current, reply) if rewrite else apply_edits(current, reply)
+            if instruction == EDIT_INSTRUCTION and HOLE in edited:
+                raise ValueError(f"{edited.count(HOLE)} holes are left")
+            return edited
+
+        try:
+            apply(code)
+            return apply, last
+        except ValueError as e:
+            error = e
+            print(f"\nedit {job['file']}: reply rejected ({e})")
+            message = f"Your reply could not be applied: {e}. Reply again with the whole corrected answer."
+    raise ValueError(f"edit rejected: {error}")
+
+async def edit_files(jobs, model, instruction, limit, trace=None):
+    stream = len(jobs) == 1
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(job):
+        async with semaphore:
+            apply, last = await edit(job, model, instruction, echo if stream else (lambda text: None), trace)
+            if stream:
+                print()
+            output_tokens = (last.get('usage') or {}).get('output_tokens')
+            print(f"edit {job['file']}: {output_tokens} output tokens for a {token_count(job['code'], model)}-token "
+                  f"file, ttft {last['ttft']:.3f}s, done in {last['latency']:.2f}s")
+            # SEARCH/REPLACE blocks are applied again to a file edited meanwhile
+            code = job["code"]
+            if changed(job["snapshot"]):
+                with open(job["file"], 'r', encoding='utf-8') as f:
+                    code = f.read()
+            replace_file(job["file"], apply(code).encode('utf-8'))
+
+    results = await asyncio.gather(*[run(job) for job in jobs], return_exceptions=True)
+    failed = 0
+    for job, result in zip(jobs, results):
+        if isinstance(result, BaseException):
+            print(f"Error: {job['file']}: {result}")
+            failed += 1
+    return failed
+
+# With a budget, the prompt keeps the whole file (or shortened file) and
+# fills the rest of the budget with the chunks of its imports and sibling
+# files that rank best against it; the model edits only the file itself.
+def edit_context(file, own, files, budget, model):
+    used = token_count(own, model)
+    if used > budget:
+        raise ValueError(f"{file} alone is {used} tokens, over the budget of {budget}")
+    extra = [(os.path.relpath(path, Path(file).resolve().parent), text[start:end])
+             for path, text in files for start, end in split_chunks(text)]
+    extra += project_chunks(file)
+    scores = bm25(terms(own), [terms(text) for _, text in extra])
+    picked = []
+    for score, (i, (name, text)) in sorted(zip(scores, enumerate(extra)), key=lambda sc: -sc[0]):
+        cost = token_count(text, model)
+        if score > 0 and used + cost <= budget:
+            picked.append((i, name, text))
+            used += cost
+    out = []
+    for name in dict.fromkeys(name for _, name, _ in sorted(picked)):
+        out.append(f"### {name}:\n")
+        out += [text for _, n, text in sorted(picked) if n == name]
+        out.append("\n")
+    return ''.join(out) + own
+
+# Like prepare(): the prompt shows the file (or shortened file) with its
+# imports expanded, while the edits apply to the file as it is
+def read_job(file, mini=None, model=None, budget=None):
+    snap = snapshot(file)
+    with open(file, 'r', encoding='utf-8') as f:
+        code = f.read()
+    own = code
+    if mini:
+        with open(mini, 'r', encoding='utf-8') as f:
+            own = f.read()
+    files = []
+    try:
+        source = expand_imports(file, own, files=files)
+    except FileNotFoundError as e:
+        print("import_file:", e.args[0], "ERROR")
+        sys.exit(1)
+    if budget:
+        try:
+            source = edit_context(file, own, files, budget, model)
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        print("context_tokens:", token_count(source, model))
+    return {"file": file, "code": code, "source": source, "snapshot": snap}
+
+# File arguments are relative to `cwd`: the daemon runs requests from
+# several directories in one process.
+async def main(argv=None, cwd=None):
+    args, flags = split_flags(sys.argv[1:] if argv is None else argv)
+    if flags.get("profile-startup"):
+        return profile_startup("holefill")
+    if len(args) < 1:
+        usage()
+    path = lambda arg: os.path.join(cwd, arg) if cwd else arg
+
+    trace = Trace() if flags.get("trace") else None
+    try:
+        budget = number_flag(flags, "budget")
+        limit = number_flag(flags, "jobs", DEFAULT_JOBS)
+    except ValueError as e:
+        print(f"Error: {e}")
+        usage()
+    if flags.get("edit"):
+        instruction = flags["edit"] if isinstance(flags["edit"], str) else EDIT_INSTRUCTION
+        if flags.get("batch"):
+            model = flags.get("model", "C")
+            jobs = [read_job(path(file), None, model, budget) for file in args]
+        else:
+            model = args[2] if len(args) > 2 else flags.get("model", "C")
+            jobs = [read_job(path(args[0]), path(args[1]) if len(args) > 1 else None, model, budget)]
+        print("model_label:", MODELS.get(model, model))
+        failed = await edit_files(jobs, model, instruction, limit, trace)
+        if trace:
+            trace.report(flags["trace"])
+        if failed:
+            sys.exit(1)
+        return
+
+    if flags.get("batch"):
+        model = flags.get("model", "C")
+        jobs = [prepare(path(file), None, model, budget) for file in args]
     else:
-        print("Error: Could not find <COMPLETION> tags in the AI's response.")
+        file = path(args[0])
+        mini = path(args[1]) if len(args) > 1 else None
+        model = args[2] if len(args) > 2 else flags.get("model", "C")
+        jobs = [prepare(file, mini, model, budget)]
+
+    ai_dir = Path.home() / '.ai'
+    ai_dir.mkdir(exist_ok=True)
+
+    prompts = [prompt for job in jobs for prompt in job["prompts"]]
+    if prompts:
+        with open(ai_dir / '.holefill', 'w', encoding='utf-8') as f:
+            f.write(f"{SYSTEM}\n###\n{prompts[-1]}")
+
+    print("model_label:", MODELS.get(model, model))
+
+    if not prompts:
+        print("No hole found.")
+        sys.exit(1)
+
+    failed = await fill([job for job in jobs if job["prompts"]], model, limit,
+                        use_cache=not flags.get("no-cache"), reuse=bool(flags.get("reuse")), trace=trace)
+    if trace:
+        trace.report(flags["trace"])
+    if failed:
         sys.exit(1)
 
-    with open(file, 'w', encoding='utf-8') as f:
-        f.write(file_code)
+# Completion log, shared by all holefill runs
+history = Log(HOLEFILL_LOG)
 
-    save_prompt_history(SYSTEM, prompt, reply, MODELS.get(model, model))
+def save_prompt_history(system: str, prompt: str, reply: str, model: str, **fields):
+    history.write(model=model, system=system, prompt=prompt, reply=reply, **fields)
 
-def save_prompt_history(system: str, prompt: str, reply: str, model: str):
-    timestamp = datetime.now().isoformat().replace(':', '-').replace('.', '-')
-    log_dir = Path.home() / '.ai' / 'prompt_history'
-    log_dir.mkdir(parents=True, exist_ok=True)
-    
-    log_path = log_dir / f"{timestamp}_{model}.log"
-    log_content = f"SYSTEM:\n{system}\n\nPROMPT:\n{prompt}\n\nREPLY:\n{reply}\n\n"
-    
-    with open(log_path, 'a', encoding='utf-8') as f:
-        f.write(log_content)
+async def run():
+    try:
+        await main()
+    finally:
+        await aclose_clients()
 
 if __name__ == "__main__":
-    import asyncio
-    asyncio.run(main())
+    # Profiled here: in the daemon it would block its event loop and
+    # measure the daemon's environment instead of the caller's
+    if "--profile-startup" in sys.argv[1:]:
+        sys.exit(profile_startup("holefill"))
+    # A running daemon (Daemon.py) answers with warm clients and caches
+    code = run_remote("holefill", sys.argv[1:])
+    if code is not None:
+        sys.exit(code)
+    asyncio.run(run())